@@ -5,13 +5,11 @@ from flask import request, abort, send_file, session
 
 import captcha
 import common as oddb
-from common import taskManager
 from database import Website
 from search.search import InvalidQueryException
 
 
 def setup_api(app):
-    taskManager.start_indexer_threads()
 
     @app.route("/api/website/by_url", methods=["GET"])
     def api_website_by_url():
@@ -75,9 +73,9 @@ def setup_api(app):
         if name:
 
             try:
-                hits = oddb.searchEngine.search(
+                params = (
                     request.json["query"],
-                    request.json["page"], request.json["per_page"],
+                    request.json.get("page", 0), request.json["per_page"],
                     request.json["sort_order"],
                     request.json["extensions"],
                     request.json["size_min"], request.json["size_max"],
@@ -86,7 +84,22 @@ def setup_api(app):
                     request.json["date_min"], request.json["date_max"]
                 )
 
-                hits = oddb.db.join_website_on_search_result(hits)
+                oddb.searchEngine.check_query(request.json["query"])
+
+                if "cursor" in request.json:
+                    # Cursor pagination: the page parameter is ignored
+                    query_key = oddb.searchCache.make_key(*(params[:1] + (0,) + params[2:]))
+                    search_after = oddb.searchEngine.parse_cursor(request.json["cursor"], query_key)
+                    hits = oddb.searchEngine.search(*params, search_after=search_after)
+                    hits = oddb.db.join_website_on_search_result(hits)
+                    hits["next_cursor"] = oddb.searchEngine.make_cursor(hits, request.json["per_page"], query_key)
+                else:
+                    cache_key = oddb.searchCache.make_key(*params)
+                    hits = oddb.searchCache.get(cache_key)
+                    if hits is None:
+                        hits = oddb.searchEngine.search(*params)
+                        hits = oddb.db.join_website_on_search_result(hits)
+                        oddb.searchCache.set(cache_key, hits)
                 oddb.logger.info("API search '" + request.json["query"] + "' by " + name)
                 return json.dumps(hits)
 
@@ -0,0 +1,50 @@
+import argparse
+import time
+
+import config
+from database import Database
+from search.links import website_root
+from search.search import ElasticSearchEngine
+
+parser = argparse.ArgumentParser(description="Store the website url and file id in the documents indexed without them")
+parser.add_argument("--concurrency", type=int, default=4, help="Number of update tasks running at the same time")
+args = parser.parse_args()
+
+es = ElasticSearchEngine(config.ES_URL, config.ES_INDEX)
+es.update_mapping()
+print("%d documents without website url, %d without file id"
+      % (es.count_docs_without_website_url(), es.count_docs_without_file_id()))
+
+websites = Database(config.DB_CONN_STR).get_all_websites().items()
+running = dict()
+updated = 0
+done = 0
+
+while websites or running:
+    while websites and len(running) < args.concurrency:
+        website_id, url = websites.pop()
+        try:
+            running[es.start_backfill_website_url(website_id, website_root(url))] = website_id
+        except Exception as e:
+            print("Could not start update of website %d: %s" % (website_id, e))
+
+    time.sleep(1)
+    for task_id, website_id in list(running.items()):
+        try:
+            progress = es.get_task_progress(task_id)
+        except Exception as e:
+            print("Could not get progress of website %d: %s" % (website_id, e))
+            continue
+        if progress["completed"]:
+            del running[task_id]
+            done += 1
+            updated += progress["updated"]
+            if progress["error"]:
+                print("Error while updating website %d: %s" % (website_id, progress["error"]))
+
+    print("%d websites done, %d left, %d documents updated" % (done, len(websites) + len(running), updated),
+          end="\r", flush=True)
+
+print()
+print("%d documents without website url, %d without file id"
+      % (es.count_docs_without_website_url(), es.count_docs_without_file_id()))
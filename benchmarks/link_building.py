@@ -0,0 +1,55 @@
+"""
+Microbenchmark of the url reconstruction of get_link_list()
+
+    python -m benchmarks.link_building [docs]
+"""
+import random
+import string
+import sys
+import time
+from urllib.parse import urljoin
+
+from search.links import build_links, website_root
+
+BASE_URL = "http://some.mirror.org/pub/linux/"
+
+
+def make_sources(count: int) -> list:
+    rand = random.Random(42)
+    words = ["".join(rand.choice(string.ascii_lowercase) for _ in range(rand.randint(3, 12))) for _ in range(500)]
+    exts = ["iso", "mp3", "mkv", "txt", "pdf", "", "tar.gz"]
+
+    sources = []
+    for i in range(count):
+        path = "/".join(rand.choice(words) for _ in range(rand.randint(0, 5)))
+        name = rand.choice(words) + ("-" + str(i) if i % 2 else " (copy #%d)" % i)
+        sources.append({"path": path, "name": name, "ext": rand.choice(exts)})
+    return sources
+
+
+def legacy(base_url, sources):
+    # Previous implementation of get_link_list()
+    for src in sources:
+        yield urljoin(base_url, "/") + src["path"] + ("/" if src["path"] != "" else "") + src["name"] + \
+              ("." if src["ext"] != "" else "") + src["ext"]
+
+
+def batched(base_url, sources, batch_size=5000):
+    root = website_root(base_url)
+    for i in range(0, len(sources), batch_size):
+        yield from build_links(root, sources[i:i + batch_size])
+
+
+def run(name, func, sources):
+    start = time.perf_counter()
+    count = sum(1 for _ in func(BASE_URL, sources))
+    elapsed = time.perf_counter() - start
+    print("%-8s %10d urls in %6.3fs: %12.0f urls/s" % (name, count, elapsed, count / elapsed))
+
+
+if __name__ == "__main__":
+    docs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    sources = make_sources(docs)
+
+    run("legacy", legacy, sources)
+    run("batched", batched, sources)
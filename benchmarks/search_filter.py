@@ -0,0 +1,81 @@
+"""
+Per-query cost of SearchFilter.should_block()
+
+    python -m benchmarks.search_filter [queries.txt] [blacklist.txt]
+
+queries.txt holds one query per line, for example the logged queries:
+
+    psql -c "COPY (SELECT query FROM SearchLogEntry) TO STDOUT" > queries.txt
+
+Synthetic queries and blacklist terms are generated when the files are not given.
+"""
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+from search.filter import SearchFilter
+
+
+def make_queries(count: int) -> list:
+    rand = random.Random(42)
+    words = ["".join(rand.choice(string.ascii_lowercase) for _ in range(rand.randint(2, 10))) for _ in range(5000)]
+    words += ["mp3", "flac", "1080p", "x264", "pdf", "Beyoncé", "Motörhead", "S01E02", "(2019)"]
+    return [" ".join(rand.choice(words) for _ in range(rand.randint(1, 6))) for _ in range(count)]
+
+
+def make_blacklist(count: int) -> list:
+    rand = random.Random(7)
+    terms = ["".join(rand.choice(string.ascii_lowercase) for _ in range(rand.randint(4, 10))) for _ in range(count)]
+    # A few phrases and substrings
+    return terms + [terms[i] + " " + terms[i + 1] for i in range(0, 20, 2)] + ["*" + t + "*" for t in terms[:20]]
+
+
+class LegacyFilter:
+    """Previous implementation: exact tokens only"""
+
+    def __init__(self, terms, table):
+        self.blacklisted_terms = set(terms)
+        self.table = table
+
+    def should_block(self, query) -> bool:
+        query = query.translate(self.table).lower()
+        for raw_token in query.split():
+            token = raw_token.strip("\"'/\\").strip()
+            if token in self.blacklisted_terms:
+                return True
+        return False
+
+
+def run(name, search_filter, queries):
+    start = time.perf_counter()
+    blocked = sum(1 for q in queries if search_filter.should_block(q))
+    elapsed = time.perf_counter() - start
+    print("%-8s %8d queries, %6d blocked in %6.3fs: %6.2f us/query"
+          % (name, len(queries), blocked, elapsed, elapsed / len(queries) * 1000000))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            queries = [line.rstrip("\n") for line in f if line.strip()]
+    else:
+        queries = make_queries(200000)
+
+    if len(sys.argv) > 2:
+        blacklist_path = sys.argv[2]
+    else:
+        fd, blacklist_path = tempfile.mkstemp(suffix=".txt")
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(make_blacklist(2000)))
+
+    search_filter = SearchFilter(blacklist_path)
+    print("%d blacklisted terms" % len(search_filter.blacklisted_terms))
+
+    run("legacy", LegacyFilter(search_filter.blacklisted_terms, search_filter.table), queries)
+    run("matcher", search_filter, queries)
+
+    if len(sys.argv) <= 2:
+        os.remove(blacklist_path)
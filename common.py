@@ -7,7 +7,12 @@ from flask import session, abort
 
 import config
 from database import Database
+from link_list import LinkListCache
+from search.cache import SearchCache
+from search.generations import GenerationStore
 from search.search import ElasticSearchEngine
+from stats import StatsGenerator
+from submissions import SubmissionQueue
 from tasks import TaskManager
 
 # Disable flask logging
@@ -25,12 +30,16 @@ for h in logger.handlers:
 logger.addHandler(file_handler)
 logger.addHandler(StreamHandler(sys.stdout))
 
+redis = r.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT)
+
 taskManager = TaskManager()
-searchEngine = ElasticSearchEngine(config.ES_URL, config.ES_INDEX)
-searchEngine.start_stats_scheduler()
+searchEngine = ElasticSearchEngine(config.ES_URL, config.ES_INDEX, generations=GenerationStore(redis))
+searchCache = SearchCache(redis, config.SEARCH_CACHE_TTL)
 db = Database(config.DB_CONN_STR)
-
-redis = r.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT)
+statsGenerator = StatsGenerator(db, searchEngine, redis)
+statsGenerator.start_scheduler()
+linkListCache = LinkListCache(searchEngine, config.LINKS_CACHE_DIR)
+submissionQueue = SubmissionQueue(redis)
 
 
 def require_role(role: str):
@@ -10,6 +10,17 @@ RESULTS_PER_PAGE = (12, 25, 50, 100, 250, 500, 1000)
 
 SUBMIT_FTP = bool(environ.get("SUBMIT_FTP", False))
 SUBMIT_HTTP = bool(environ.get("SUBMIT_HTTP", True))
+# Pages fetched to validate submitted open directories are cached for OD_CHECK_CACHE_TTL seconds
+OD_CHECK_TIMEOUT = float(environ.get("OD_CHECK_TIMEOUT", 30))
+OD_CHECK_CACHE_TTL = int(environ.get("OD_CHECK_CACHE_TTL", 600))
+OD_CHECK_THREADS = int(environ.get("OD_CHECK_THREADS", 8))
+# Submissions of /enqueue_bulk and mass_import.py are validated by submission_worker.py
+SUBMIT_WORKER_THREADS = int(environ.get("SUBMIT_WORKER_THREADS", 8))
+# Minimum delay in seconds between the validation of two urls of the same host
+SUBMIT_HOST_INTERVAL = float(environ.get("SUBMIT_HOST_INTERVAL", 2))
+# Rejected urls are not validated again for this long (seconds)
+SUBMIT_RESULT_TTL = int(environ.get("SUBMIT_RESULT_TTL", 24 * 3600))
+SUBMIT_JOB_TTL = int(environ.get("SUBMIT_JOB_TTL", 7 * 24 * 3600))
 
 TT_API = environ.get("TT_API", "http://localhost:3010")
 TT_CRAWL_PROJECT = int(environ.get("TT_CRAWL_PROJECT", 3))
@@ -26,4 +37,63 @@ REDIS_PORT = environ.get("REDIS_PORT", 6379)
 
 DB_CONN_STR = environ.get("DB_CONN_STR", "dbname=od_database user=od_database password=od_database")
 RECRAWL_POOL_SIZE = environ.get("RECRAWL_POOL_SIZE", 10000)
+# Number of crawl tasks submitted to the tracker at the same time
+QUEUE_CONCURRENCY = int(environ.get("QUEUE_CONCURRENCY", 30))
+# Number of tasks whose result is reported together in the logs
+QUEUE_BATCH_SIZE = int(environ.get("QUEUE_BATCH_SIZE", 500))
+# Maximum number of tasks submitted per second (each one is a tracker and a bucket request), 0 for no limit
+QUEUE_RATE = float(environ.get("QUEUE_RATE", 100))
+QUEUE_MAX_RETRIES = int(environ.get("QUEUE_MAX_RETRIES", 4))
+# Re-crawl intervals in days, adapted to the change rate of each website (see recrawl.py).
+# RECRAWL_DEFAULT_INTERVAL applies to websites without change history
+RECRAWL_MIN_INTERVAL = float(environ.get("RECRAWL_MIN_INTERVAL", 1))
+RECRAWL_MAX_INTERVAL = float(environ.get("RECRAWL_MAX_INTERVAL", 90))
+RECRAWL_DEFAULT_INTERVAL = float(environ.get("RECRAWL_DEFAULT_INTERVAL", 14))
+# A website is due when the expected fraction of its files that changed since the last crawl reaches this
+RECRAWL_TARGET_CHANGE = float(environ.get("RECRAWL_TARGET_CHANGE", 0.1))
+# The interval of websites with more files than this is stretched
+RECRAWL_LARGE_SITE = int(environ.get("RECRAWL_LARGE_SITE", 100000))
+# Maximum number of files to crawl and index per re-crawl run
+RECRAWL_BUDGET = int(environ.get("RECRAWL_BUDGET", 20000000))
+RECRAWL_HISTORY_SIZE = int(environ.get("RECRAWL_HISTORY_SIZE", 8))
 INDEXER_THREADS = int(environ.get("INDEXER_THREAD", 3))
+DB_POOL_SIZE = int(environ.get("DB_POOL_SIZE", 16))
+DB_POOL_TIMEOUT = float(environ.get("DB_POOL_TIMEOUT", 10))
+DB_POOL_PING_INTERVAL = float(environ.get("DB_POOL_PING_INTERVAL", 30))
+SEARCH_LOG_QUEUE_SIZE = int(environ.get("SEARCH_LOG_QUEUE_SIZE", 10000))
+SEARCH_LOG_BATCH_SIZE = int(environ.get("SEARCH_LOG_BATCH_SIZE", 500))
+SEARCH_LOG_FLUSH_INTERVAL = float(environ.get("SEARCH_LOG_FLUSH_INTERVAL", 5))
+# What to do when the search log queue is full: "drop" the entry or "block" the request until there is room
+SEARCH_LOG_OVERFLOW = environ.get("SEARCH_LOG_OVERFLOW", "drop")
+INDEXER_BULK_MAX_BYTES = int(environ.get("INDEXER_BULK_MAX_BYTES", 10 * 1024 * 1024))
+INDEXER_BULK_IN_FLIGHT = int(environ.get("INDEXER_BULK_IN_FLIGHT", 4))
+# The indexer scales between INDEXER_MIN_THREADS and INDEXER_MAX_THREADS, starting at INDEXER_THREADS
+INDEXER_MIN_THREADS = int(environ.get("INDEXER_MIN_THREADS", 1))
+INDEXER_MAX_THREADS = int(environ.get("INDEXER_MAX_THREADS", 8))
+# Upper bound of the total size of the bulk requests in flight across all indexer threads
+INDEXER_MAX_IN_FLIGHT_BYTES = int(environ.get("INDEXER_MAX_IN_FLIGHT_BYTES", 64 * 1024 * 1024))
+# Concurrency is reduced when the average bulk request takes longer than this (seconds)
+INDEXER_TARGET_LATENCY = float(environ.get("INDEXER_TARGET_LATENCY", 5))
+INDEXER_SCALE_INTERVAL = int(environ.get("INDEXER_SCALE_INTERVAL", 15))
+# Maximum delay between two polls of the task tracker by an idle indexer thread
+INDEXER_IDLE_MAX = int(environ.get("INDEXER_IDLE_MAX", 60))
+# "full": delete all documents of a website then re-index the crawl, received in a temporary file first
+# (the other modes index the documents while the crawl is downloaded)
+# "incremental": only index new/changed documents and delete the missing ones
+# "generation": index the crawl as a new hidden generation and swap it with the live one when complete
+INDEXING_MODE = environ.get("INDEXING_MODE", "incremental")
+# Store the root url of the website in each document, search results and exports then need no join
+INDEX_WEBSITE_URL = environ.get("INDEX_WEBSITE_URL", "true").lower() in ("1", "true", "yes")
+# Time to live of cached search result pages in seconds, 0 to disable the cache.
+# Newly indexed files can take that long to appear in the results of a cached query
+SEARCH_CACHE_TTL = int(environ.get("SEARCH_CACHE_TTL", 300))
+# Number of sliced scrolls (and worker processes) used by export.py
+EXPORT_SLICES = int(environ.get("EXPORT_SLICES", 8))
+# Interval in seconds between two merges of the per-website stats into the global stats
+STATS_INTERVAL = int(environ.get("STATS_INTERVAL", 300))
+# Directory where the compressed link lists of websites are cached
+LINKS_CACHE_DIR = environ.get("LINKS_CACHE_DIR", "links_cache/")
+DOWNLOAD_CHUNK_SIZE = int(environ.get("DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+# Crawl results are buffered in memory up to this size, then spilled to a temporary file
+DOWNLOAD_MAX_MEMORY = int(environ.get("DOWNLOAD_MAX_MEMORY", 256 * 1024 * 1024))
+DOWNLOAD_MAX_RETRIES = int(environ.get("DOWNLOAD_MAX_RETRIES", 5))
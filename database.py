@@ -1,10 +1,362 @@
+import atexit
+import logging
 import os
+import select
+import threading
 import time
 import uuid
-from urllib.parse import urlparse, urljoin
+from collections import deque
+from contextlib import contextmanager
+from queue import Queue, Full, Empty
+from urllib.parse import urlparse
 
 import bcrypt
 import psycopg2
+from psycopg2.extras import execute_values, Json
+
+import config
+from search.links import website_root
+
+logger = logging.getLogger("default")
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+def like_prefix(prefix: str) -> str:
+    """LIKE pattern matching the strings that start with prefix"""
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of PostgreSQL connections shared by the threads of a process"""
+
+    def __init__(self, db_conn_str, max_size: int, timeout: float, ping_interval: float):
+        self.db_conn_str = db_conn_str
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Connections are not fork-safe: a child process (uwsgi worker) starts with an empty pool
+        # and leaves the parent's sockets alone.
+        self._pid = os.getpid()
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._in_use = 0
+        self._metrics = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "connects": 0,
+            "discarded": 0,
+            "wait_time": 0.0,
+            "wait_time_max": 0.0,
+            "checkout_time": 0.0,
+            "checkout_time_max": 0.0,
+        }
+
+    @contextmanager
+    def connection(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+        conn = self._checkout()
+        checkout_start = time.time()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._checkin(conn, time.time() - checkout_start)
+
+    def _checkout(self):
+        wait_start = time.time()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._metrics["timeouts"] += 1
+            raise PoolTimeoutError("Timed out waiting for a database connection (pool size: %d)" % self.max_size)
+        wait_time = time.time() - wait_start
+
+        try:
+            conn = self._get_healthy_connection()
+        except:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+            self._metrics["checkouts"] += 1
+            self._metrics["wait_time"] += wait_time
+            self._metrics["wait_time_max"] = max(self._metrics["wait_time_max"], wait_time)
+        return conn
+
+    def _get_healthy_connection(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+
+            if conn.closed:
+                self._discard(conn)
+                continue
+
+            if time.time() - last_used > self.ping_interval:
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                    conn.rollback()
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    # Server restarted or failed over: the other idle connections are most likely dead too
+                    self._discard(conn)
+                    self._discard_idle()
+                    continue
+            return conn
+
+        conn = psycopg2.connect(self.db_conn_str)
+        with self._lock:
+            self._metrics["connects"] += 1
+        return conn
+
+    def _checkin(self, conn, checkout_time: float):
+        with self._lock:
+            self._in_use -= 1
+            self._metrics["checkout_time"] += checkout_time
+            self._metrics["checkout_time_max"] = max(self._metrics["checkout_time_max"], checkout_time)
+
+        if conn.closed:
+            # closed == 2 means the connection was lost while in use (server restart, failover...)
+            lost = conn.closed == 2
+            self._discard(conn)
+            if lost:
+                self._discard_idle()
+        else:
+            with self._lock:
+                self._idle.append((conn, time.time()))
+        self._slots.release()
+
+    def _discard(self, conn):
+        with self._lock:
+            self._metrics["discarded"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _discard_idle(self):
+        with self._lock:
+            stale = list(self._idle)
+            self._idle.clear()
+        for conn, _ in stale:
+            self._discard(conn)
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["max_size"] = self.max_size
+            metrics["in_use"] = self._in_use
+            metrics["idle"] = len(self._idle)
+
+        checkouts = metrics["checkouts"] if metrics["checkouts"] != 0 else 1
+        metrics["wait_time_avg"] = metrics["wait_time"] / checkouts
+        metrics["checkout_time_avg"] = metrics["checkout_time"] / checkouts
+        return metrics
+
+
+class WebsiteMap:
+    """
+    website id -> url of every website, loaded once per process then kept up to date with the
+    notifications sent by the website_notify trigger. Urls are stored in a list indexed by website
+    id, root urls are sliced from them on lookup. Ids that are not in the map, and every lookup made before the initial
+    load completes, go to the database.
+    """
+
+    CHANNEL = "website_changes"
+    # Ids looked up in the database and not found are not looked up again for this long
+    MISSING_TTL = 60
+    # Deletions remembered to discard database lookups that were in flight when they happened
+    DELETED_KEEP = 1000
+
+    def __init__(self, pool: ConnectionPool, db_conn_str):
+        self.pool = pool
+        self.db_conn_str = db_conn_str
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._urls = []
+        self._count = 0
+        self._missing = dict()
+        self._deleted = dict()
+        self._delete_seq = 0
+        self._ready = threading.Event()
+
+        t = threading.Thread(target=self._listen, daemon=True)
+        t.start()
+
+    def _ensure_started(self):
+        # Started on first use in each process: the listener thread does not survive a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.db_conn_str)
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute("LISTEN " + self.CHANNEL)
+
+                # Changes made during the load are queued on the listening connection
+                self._load()
+                self._ready.set()
+
+                while True:
+                    if select.select([conn], [], [], 60) != ([], [], []):
+                        conn.poll()
+                        website_ids = set()
+                        while conn.notifies:
+                            website_ids.add(self._parse(conn.notifies.pop(0).payload))
+                        self._refresh(cursor, website_ids)
+            except Exception as e:
+                logger.error("Website map listener error: %s, reloading" % e)
+                time.sleep(5)
+            finally:
+                if conn:
+                    conn.close()
+
+    def _load(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, url FROM Website")
+
+            urls = []
+            count = 0
+            for website_id, url in cursor.fetchall():
+                if website_id >= len(urls):
+                    urls.extend([None] * (website_id + 1 - len(urls)))
+                urls[website_id] = url
+                count += 1
+
+        with self._lock:
+            self._urls = urls
+            self._count = count
+            self._missing.clear()
+        logger.debug("Loaded %d websites" % count)
+
+    @staticmethod
+    def _parse(payload: str) -> int:
+        """payload: <operation> <website id>, urls are not sent (notification payloads are limited in size)"""
+        return int(payload.split(" ")[1])
+
+    def _refresh(self, cursor, website_ids: set):
+        """Read the notified websites again, the rows that are gone were deleted"""
+        cursor.execute("SELECT id, url FROM Website WHERE id = ANY(%s)", (list(website_ids),))
+        urls = dict(cursor.fetchall())
+
+        for website_id in website_ids:
+            self._set(website_id, urls.get(website_id))
+
+    def _set(self, website_id: int, url, delete_seq=None):
+        """delete_seq: set by database lookups, discarded if the website was deleted after the lookup started"""
+        with self._lock:
+            if delete_seq is not None:
+                if self._deleted.get(website_id, -1) >= delete_seq:
+                    return
+                if website_id < len(self._urls) and self._urls[website_id] is not None:
+                    # Set by a notification in the meantime
+                    return
+
+            if url is None:
+                self._delete_seq += 1
+                self._deleted[website_id] = self._delete_seq
+                if len(self._deleted) > self.DELETED_KEEP * 2:
+                    self._deleted = {i: s for i, s in self._deleted.items()
+                                     if s > self._delete_seq - self.DELETED_KEEP}
+
+            if website_id >= len(self._urls):
+                if url is None:
+                    return
+                self._urls.extend([None] * (website_id + 1 - len(self._urls)))
+
+            if self._urls[website_id] is None and url is not None:
+                self._count += 1
+            elif self._urls[website_id] is not None and url is None:
+                self._count -= 1
+            self._urls[website_id] = url
+            self._missing.pop(website_id, None)
+
+    @staticmethod
+    def _root(url: str) -> str:
+        """website_root() without parsing the url, for the urls that start with scheme://netloc/"""
+        start = url.find("//")
+        end = url.find("/", start + 2) if start > 0 else -1
+        if end < 0 or not url[:start].islower() or "?" in url[:end] or "#" in url[:end]:
+            return website_root(url)
+        return url[:end + 1]
+
+    def get(self, website_id: int, default=None):
+        self._ensure_started()
+
+        urls = self._urls
+        url = urls[website_id] if 0 <= website_id < len(urls) else None
+        if url is not None:
+            return url
+
+        missing = self._missing.get(website_id)
+        if missing and missing + self.MISSING_TTL > time.time():
+            return default
+
+        # Not loaded yet, or a notification was missed
+        delete_seq = self._delete_seq + 1
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT url FROM Website WHERE id=%s", (website_id,))
+            row = cursor.fetchone()
+
+        if row:
+            self._set(website_id, row[0], delete_seq)
+            return row[0]
+        self._missing[website_id] = time.time()
+        return default
+
+    def get_root(self, website_id: int, default=None):
+        url = self.get(website_id)
+        return self._root(url) if url is not None else default
+
+    def _select_all(self) -> list:
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, url FROM Website ORDER BY id")
+            return cursor.fetchall()
+
+    def items(self):
+        self._ensure_started()
+        if not self._ready.is_set():
+            return self._select_all()
+        return [(website_id, url) for website_id, url in enumerate(self._urls) if url is not None]
+
+    def roots(self) -> dict:
+        """website id -> root url of every website"""
+        return {website_id: self._root(url) for website_id, url in self.items()}
+
+    def __len__(self):
+        self._ensure_started()
+        if not self._ready.is_set():
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT COUNT(*) FROM Website")
+                return cursor.fetchone()[0]
+        return self._count
 
 
 class BlacklistedWebsite:
@@ -30,14 +382,131 @@ class ApiClient:
         self.name = name
 
 
+class SearchLogWriter:
+    """Write-behind buffer for SearchLogEntry rows, flushed in batches by a background thread"""
+
+    OVERFLOW_DROP = "drop"
+    OVERFLOW_BLOCK = "block"
+
+    _STOP = object()
+
+    def __init__(self, pool: ConnectionPool, queue_size: int, batch_size: int, flush_interval: float,
+                 overflow: str):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.queue_size = queue_size
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.close)
+
+    def put(self, row: tuple):
+        self._ensure_started()
+
+        if self.overflow == SearchLogWriter.OVERFLOW_BLOCK:
+            self._queue.put(row)
+        else:
+            try:
+                self._queue.put_nowait(row)
+            except Full:
+                with self._lock:
+                    self.dropped += 1
+
+    def _run(self):
+        batch = []
+        deadline = time.time() + self.flush_interval
+        stopping = False
+
+        while not stopping:
+            try:
+                row = self._queue.get(timeout=max(0.0, deadline - time.time()))
+                if row is SearchLogWriter._STOP:
+                    stopping = True
+                else:
+                    batch.append(row)
+            except Empty:
+                pass
+
+            if batch and (stopping or len(batch) >= self.batch_size or time.time() >= deadline):
+                self._flush(batch)
+                batch = []
+            if time.time() >= deadline:
+                deadline = time.time() + self.flush_interval
+
+    def _flush(self, batch: list):
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                execute_values(cursor,
+                               "INSERT INTO SearchLogEntry "
+                               "(remote_addr, forwarded_for, query, extensions, page, blocked, results, took) "
+                               "VALUES %s", batch, page_size=len(batch))
+            with self._lock:
+                self.written += len(batch)
+                self.flushes += 1
+        except Exception as e:
+            logger.error("Could not write %d search log entries: %s" % (len(batch), e))
+            with self._lock:
+                self.failed += len(batch)
+
+    def close(self, timeout: float = 30):
+        """Flush everything that is still queued and stop the background thread"""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            # Always let the stop marker through, even when the queue is full in "drop" mode
+            self._queue.put(SearchLogWriter._STOP, timeout=timeout)
+        except Full:
+            logger.error("Search log queue is still full on shutdown, some entries will be lost")
+            return
+        self._thread.join(timeout)
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            return {
+                "queued": self._queue.qsize() if self._queue else 0,
+                "queue_size": self.queue_size,
+                "overflow": self.overflow,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "flushes": self.flushes,
+            }
+
+
 class Database:
 
     def __init__(self, db_conn_str):
         self.db_conn_str = db_conn_str
-        self.website_cache = dict()
-        self.website_cache_time = 0
-
-        with psycopg2.connect(self.db_conn_str) as conn:
+        self.pool = ConnectionPool(db_conn_str, config.DB_POOL_SIZE, config.DB_POOL_TIMEOUT,
+                                   config.DB_POOL_PING_INTERVAL)
+        self.search_log = SearchLogWriter(self.pool, config.SEARCH_LOG_QUEUE_SIZE, config.SEARCH_LOG_BATCH_SIZE,
+                                          config.SEARCH_LOG_FLUSH_INTERVAL, config.SEARCH_LOG_OVERFLOW)
+        self.websites = WebsiteMap(self.pool, db_conn_str)
+        self.blacklist_netlocs = set()
+        self.blacklist_time = 0
+
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_tables "
                            "WHERE tablename = 'searchlogentry')")
@@ -52,20 +521,30 @@ class Database:
         with open("init_script.sql", "r") as f:
             init_script = f.read()
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cur = conn.cursor()
             cur.execute(init_script)
 
+    def migrate_database(self):
+        """Apply migrations.sql, run once by migrate.py (not by every process) after an update"""
+
+        with open("migrations.sql", "r") as f:
+            migration_script = f.read()
+
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(migration_script)
+
     def update_website_date_if_exists(self, website_id):
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE Website SET last_modified=CURRENT_TIMESTAMP WHERE id=%s", (website_id,))
             conn.commit()
 
     def insert_website(self, website: Website):
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT INTO Website (url, logged_ip, logged_useragent) VALUES (%s,%s,%s) RETURNING id",
                            (website.url, str(website.logged_ip), str(website.logged_useragent)))
@@ -77,7 +556,7 @@ class Database:
 
     def get_website_by_url(self, url):
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("SELECT id, url, logged_ip, logged_useragent, last_modified FROM Website WHERE url=%s",
@@ -91,7 +570,7 @@ class Database:
 
     def get_website_by_id(self, website_id):
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("SELECT * FROM Website WHERE id=%s", (website_id,))
@@ -106,18 +585,19 @@ class Database:
 
     def get_websites(self, per_page, page: int, url):
         """Get all websites"""
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("SELECT Website.id, Website.url, Website.last_modified FROM Website "
                            "WHERE Website.url LIKE %s "
-                           "ORDER BY last_modified DESC LIMIT %s OFFSET %s", (url + "%", per_page, page * per_page))
+                           "ORDER BY last_modified DESC LIMIT %s OFFSET %s",
+                           (like_prefix(url), per_page, page * per_page))
 
             return cursor.fetchall()
 
     def get_random_website_id(self):
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT id FROM Website ORDER BY random() LIMIT 1")
 
@@ -128,23 +608,25 @@ class Database:
 
     def website_exists(self, url):
         """Check if an url or the parent directory of an url already exists"""
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
-            cursor.execute("SELECT id FROM Website WHERE url = substr(%s, 0, length(url) + 1)", (url,))
+            # Only the websites of the same host can be a prefix of the url (indexed)
+            cursor.execute("SELECT id FROM Website WHERE netloc = url_netloc(%s) "
+                           "AND url = substr(%s, 0, length(url) + 1)", (url, url))
             website_id = cursor.fetchone()
             return website_id[0] if website_id else None
 
     def delete_website(self, website_id):
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("DELETE FROM Website WHERE id=%s", (website_id,))
             conn.commit()
 
     def check_login(self, username, password) -> bool:
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("SELECT password FROM Admin WHERE username=%s", (username,))
@@ -156,7 +638,7 @@ class Database:
             return False
 
     def get_user_role(self, username: str):
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("SELECT role FROM Admin WHERE username=%s", (username,))
@@ -169,7 +651,7 @@ class Database:
 
     def generate_login(self, username, password) -> None:
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             hashed_pw = bcrypt.hashpw(password.encode(), bcrypt.gensalt(12))
@@ -180,7 +662,7 @@ class Database:
 
     def check_api_token(self, token) -> str:
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("SELECT name FROM ApiClient WHERE token=%s", (token,))
@@ -189,7 +671,7 @@ class Database:
 
     def generate_api_token(self, name: str) -> str:
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             token = str(uuid.uuid4())
@@ -200,7 +682,7 @@ class Database:
 
     def get_tokens(self) -> list:
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("SELECT token, name FROM ApiClient")
@@ -209,122 +691,168 @@ class Database:
 
     def delete_token(self, token: str) -> None:
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("DELETE FROM ApiClient WHERE token=%s", (token,))
             conn.commit()
 
-    def get_all_websites(self) -> dict:
-        if self.website_cache_time + 120 < time.time():
-            with psycopg2.connect(self.db_conn_str) as conn:
-                cursor = conn.cursor()
-
-                cursor.execute("SELECT id, url FROM Website")
-
-                result = dict()
-
-                for db_website in cursor.fetchall():
-                    result[db_website[0]] = db_website[1]
-
-                self.website_cache = result
-                self.website_cache_time = time.time()
+    def get_all_websites(self) -> WebsiteMap:
+        return self.websites
 
-        return self.website_cache
+    def get_website_roots(self) -> dict:
+        """website id -> root url of every website"""
+        return self.websites.roots()
 
     def join_website_on_search_result(self, page: dict) -> dict:
 
-        websites = self.get_all_websites()
-
         for hit in page["hits"]["hits"]:
-            if hit["_source"]["website_id"] in websites:
-                hit["_source"]["website_url"] = urljoin(websites[hit["_source"]["website_id"]], "/")
-            else:
-                hit["_source"]["website_url"] = "[DELETED]"
+            # Documents indexed with their website url need no lookup
+            if "website_url" not in hit["_source"]:
+                hit["_source"]["website_url"] = self.websites.get_root(hit["_source"]["website_id"], "[DELETED]")
 
         return page
 
     def join_website_url(self, docs):
 
-        websites = self.get_all_websites()
-
         for doc in docs:
-            if doc["_source"]["website_id"] in websites:
-                doc["_source"]["website_url"] = urljoin(websites[doc["_source"]["website_id"]], "/")
-            else:
-                doc["_source"]["website_url"] = "[DELETED]"
-
+            if "website_url" not in doc["_source"]:
+                doc["_source"]["website_url"] = self.websites.get_root(doc["_source"]["website_id"], "[DELETED]")
             yield doc
 
     def join_website_on_stats(self, stats):
 
-        websites = self.get_all_websites()
-
-        for website in stats["website_scatter"]:
-            website[0] = websites.get(website[0], "[DELETED]")
+        stats["website_scatter"] = [[self.websites.get(website[0], "[DELETED]")] + website[1:]
+                                    for website in stats["website_scatter"]]
 
     def add_blacklist_website(self, url):
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             parsed_url = urlparse(url)
             url = parsed_url.scheme + "://" + parsed_url.netloc
             cursor.execute("INSERT INTO BlacklistedWebsite (url) VALUES (%s)", (url,))
             conn.commit()
+        self.blacklist_time = 0
 
     def remove_blacklist_website(self, blacklist_id):
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("DELETE FROM BlacklistedWebsite WHERE id=%s", (blacklist_id,))
             conn.commit()
+        self.blacklist_time = 0
 
-    def is_blacklisted(self, url):
+    def get_blacklist_netlocs(self) -> set:
+        """Reloaded when changed by this process, other processes see changes within a minute"""
+        if self.blacklist_time + 60 < time.time():
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT url FROM BlacklistedWebsite")
 
-        with psycopg2.connect(self.db_conn_str) as conn:
-            cursor = conn.cursor()
-            parsed_url = urlparse(url)
-            url = parsed_url.scheme + "://" + parsed_url.netloc
-            print(url)
-            cursor.execute("SELECT id FROM BlacklistedWebsite WHERE url LIKE %s LIMIT 1", (url,))
+                self.blacklist_netlocs = {urlparse(r[0]).netloc.lower() for r in cursor.fetchall()}
+                self.blacklist_time = time.time()
 
-            return cursor.fetchone() is not None
+        return self.blacklist_netlocs
+
+    def is_blacklisted(self, url):
+        return urlparse(url).netloc.lower() in self.get_blacklist_netlocs()
 
     def get_blacklist(self):
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("SELECT * FROM BlacklistedWebsite")
             return [BlacklistedWebsite(r[0], r[1]) for r in cursor.fetchall()]
 
     def log_search(self, remote_addr, forwarded_for, q, exts, page, blocked, results, took):
+        """Queue a search log entry, it is written to the database asynchronously"""
+
+        self.search_log.put((remote_addr, forwarded_for, q, ",".join(exts), page, blocked, results, took))
+
+    def set_website_stats(self, website_id: int, stats: dict):
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO WebsiteStats (website_id, stats) SELECT id, %s FROM Website WHERE id=%s "
+                           "ON CONFLICT (website_id) DO UPDATE "
+                           "SET stats=EXCLUDED.stats, last_modified=CURRENT_TIMESTAMP",
+                           (Json(stats), website_id))
+            conn.commit()
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+    def get_website_stats(self, website_id: int):
+
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
+            cursor.execute("SELECT stats FROM WebsiteStats WHERE website_id=%s", (website_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
 
-            cursor.execute(
-                "INSERT INTO SearchLogEntry "
-                "(remote_addr, forwarded_for, query, extensions, page, blocked, results, took) "
-                "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
-                (remote_addr, forwarded_for, q, ",".join(exts), page, blocked, results, took))
+    def delete_website_stats(self, website_id: int):
 
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM WebsiteStats WHERE website_id=%s", (website_id,))
             conn.commit()
 
-    def get_oldest_updated_websites(self, size: int, prefix: str):
+    def iter_website_stats(self):
+        """Yields (website_id, stats) of every website"""
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor(name="website_stats")
+            cursor.itersize = 5000
+            cursor.execute("SELECT website_id, stats FROM WebsiteStats")
+
+            for row in cursor:
+                yield row[0], row[1]
+
+    def get_websites_without_stats(self, size: int) -> list:
 
-        with psycopg2.connect(self.db_conn_str) as conn:
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
+            cursor.execute("SELECT id FROM Website LEFT JOIN WebsiteStats ON Website.id = WebsiteStats.website_id "
+                           "WHERE WebsiteStats.website_id IS NULL ORDER BY id LIMIT %s", (size,))
+            return [r[0] for r in cursor.fetchall()]
+
+    def insert_crawl_history(self, website_id: int, file_count: int, total_size: int, changed, duration: float):
+        """Must be called before the website date is updated, elapsed is the time since the previous crawl"""
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO CrawlHistory (website_id, elapsed, file_count, total_size, changed, duration) "
+                           "SELECT id, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - last_modified), %s, %s, %s, %s "
+                           "FROM Website WHERE id=%s",
+                           (file_count, total_size, changed, duration, website_id))
+            conn.commit()
 
-            cursor.execute("SELECT id, url, last_modified FROM website "
-                           "WHERE url LIKE %s "
-                           "ORDER BY last_modified ASC LIMIT %s",
-                           (prefix + "%", size, ))
-            return [Website(url=r[1],
-                            website_id=r[0],
-                            last_modified=r[2],
-                            logged_ip=None,
-                            logged_useragent=None
-                            )
-                    for r in cursor.fetchall()]
+    def get_crawl_histories(self, prefix: str, history_size: int):
+        """
+        Yields (website, history) for every website, history is the list of its last
+        crawls (crawl_time, elapsed, file_count, total_size, changed, duration), oldest first
+        """
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor(name="crawl_histories")
+            cursor.itersize = 5000
+            cursor.execute("SELECT w.id, w.url, w.last_modified, h.crawl_time, h.elapsed, h.file_count, "
+                           "h.total_size, h.changed, h.duration FROM Website w "
+                           "LEFT JOIN LATERAL (SELECT * FROM CrawlHistory WHERE website_id=w.id "
+                           "ORDER BY crawl_time DESC LIMIT %s) h ON TRUE "
+                           "WHERE w.url LIKE %s ORDER BY w.id, h.crawl_time",
+                           (history_size, like_prefix(prefix)))
+
+            website = None
+            history = []
+            for row in cursor:
+                if website is None or website.id != row[0]:
+                    if website:
+                        yield website, history
+                    website = Website(url=row[1], website_id=row[0], last_modified=row[2],
+                                      logged_ip=None, logged_useragent=None)
+                    history = []
+                if row[3] is not None:
+                    history.append(row[3:])
+            if website:
+                yield website, history
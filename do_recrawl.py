@@ -1,4 +1,28 @@
-from tasks import TaskManager
+import argparse
+import json
 
-tm = TaskManager()
-tm.do_recrawl()
+import config
+import database
+from recrawl import RecrawlScheduler
+
+parser = argparse.ArgumentParser(description="Queue re-crawl tasks for the websites that are due")
+parser.add_argument("--dry-run", action="store_true", help="Print the re-crawl queue without queuing it")
+parser.add_argument("--simulate", type=int, metavar="DAYS",
+                    help="Compare the adaptive schedule with oldest-first over DAYS days of crawl history")
+args = parser.parse_args()
+
+if args.dry_run or args.simulate:
+    scheduler = RecrawlScheduler(database.Database(config.DB_CONN_STR))
+    estimates = scheduler.get_estimates()
+
+    if args.simulate:
+        print(json.dumps(scheduler.simulate(estimates, args.simulate), indent=2))
+    else:
+        for e in scheduler.plan(estimates):
+            print("%d\t%s\tfiles=%d\tinterval=%.1fd\trate=%s"
+                  % (e.website.id, e.website.url, e.files, e.interval / 86400, e.rate))
+else:
+    from tasks import TaskManager
+
+    tm = TaskManager()
+    tm.do_recrawl()
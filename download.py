@@ -0,0 +1,230 @@
+import codecs
+import logging
+import time
+import zlib
+from collections import deque
+from tempfile import TemporaryFile
+from threading import Condition, Thread
+
+import requests
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("default")
+
+
+class DownloadAborted(Exception):
+    pass
+
+
+class SpillBuffer:
+    """
+    FIFO byte buffer between a download and its consumer. Chunks are kept in memory up to max_memory
+    bytes, after that they are spilled to a temporary file so that a slow consumer never stalls the
+    download (and the connection is not kept open for the whole indexing time).
+    """
+
+    def __init__(self, max_memory: int, read_size: int):
+        self.max_memory = max_memory
+        self.read_size = read_size
+
+        self._cond = Condition()
+        self._chunks = deque()
+        self._memory = 0
+        self._file = None
+        self._write_pos = 0
+        self._read_pos = 0
+        self._eof = False
+        self._error = None
+        self._aborted = False
+
+    def write(self, chunk: bytes):
+        with self._cond:
+            if self._aborted:
+                raise DownloadAborted()
+
+            # Once spilling started, everything goes through the file to keep the order
+            if self._file is None and self._memory + len(chunk) <= self.max_memory:
+                self._chunks.append(chunk)
+                self._memory += len(chunk)
+            else:
+                if self._file is None:
+                    self._file = TemporaryFile()
+                self._file.seek(self._write_pos)
+                self._file.write(chunk)
+                self._write_pos += len(chunk)
+            self._cond.notify()
+
+    def close(self, error: Exception = None):
+        """Called by the producer at the end of the download"""
+        with self._cond:
+            self._eof = True
+            self._error = error
+            self._cond.notify()
+
+    def abort(self):
+        """Called by the consumer when it stops reading, the producer fails on its next write"""
+        with self._cond:
+            self._aborted = True
+            self._chunks.clear()
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def read(self) -> bytes:
+        """Next chunk, b"" at the end of the download"""
+        with self._cond:
+            while True:
+                if self._chunks:
+                    chunk = self._chunks.popleft()
+                    self._memory -= len(chunk)
+                    return chunk
+
+                if self._file and self._read_pos < self._write_pos:
+                    self._file.seek(self._read_pos)
+                    chunk = self._file.read(min(self.read_size, self._write_pos - self._read_pos))
+                    self._read_pos += len(chunk)
+                    if self._read_pos == self._write_pos:
+                        # Caught up with the download, go back to memory
+                        self._file.close()
+                        self._file = None
+                        self._read_pos = self._write_pos = 0
+                    return chunk
+
+                if self._error:
+                    raise self._error
+                if self._eof:
+                    return b""
+                self._cond.wait()
+
+
+class _MultiFrameDecompressor:
+    """Decompress concatenated gzip members / lz4 frames"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.decompressor = factory()
+
+    def decompress(self, data: bytes) -> bytes:
+        out = []
+        while data:
+            out.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            data = self.decompressor.unused_data
+            self.decompressor = self.factory()
+        return b"".join(out)
+
+
+class _Identity:
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return data
+
+
+def _make_decompressor(head: bytes):
+    if head.startswith(b"\x1f\x8b"):
+        return _MultiFrameDecompressor(lambda: zlib.decompressobj(wbits=31))
+    if head.startswith(b"\x04\x22\x4d\x18"):
+        import lz4.frame
+        return _MultiFrameDecompressor(lz4.frame.LZ4FrameDecompressor)
+    if head.startswith(b"\x28\xb5\x2f\xfd"):
+        if not zstandard:
+            raise ValueError("Received a zstd compressed file but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return _Identity()
+
+
+def _download(url: str, buffer: SpillBuffer, chunk_size: int, max_retries: int):
+    """Write the raw (still compressed) body to the buffer, resuming with a Range request if it is cut"""
+    offset = 0
+    attempt = 0
+
+    try:
+        while True:
+            headers = {"Range": "bytes=%d-" % offset} if offset else {}
+            r = requests.get(url, stream=True, headers=headers, timeout=60)
+
+            if r.status_code == 206:
+                skip = 0
+            elif r.status_code == 200:
+                # Range not supported: start over, skipping what was already received
+                skip = offset
+            else:
+                raise ValueError("HTTP error %d: %s" % (r.status_code, url))
+
+            expected = int(r.headers["Content-Length"]) + offset - skip if "Content-Length" in r.headers else None
+            position = offset - skip
+
+            try:
+                for chunk in r.raw.stream(chunk_size, decode_content=False):
+                    position += len(chunk)
+                    if position <= offset:
+                        continue
+                    if position - len(chunk) < offset:
+                        chunk = chunk[offset - (position - len(chunk)):]
+                    buffer.write(chunk)
+                    offset = position
+
+                if expected is not None and offset < expected:
+                    raise ConnectionError("Got %d/%d bytes" % (offset, expected))
+                break
+
+            except DownloadAborted:
+                raise
+            except Exception as e:
+                attempt += 1
+                if attempt > max_retries:
+                    raise
+                logger.warning("Download of %s interrupted at %d bytes (%s), resuming" % (url, offset, e))
+                time.sleep(2 ** attempt)
+            finally:
+                r.close()
+
+        logger.debug("Downloaded %d bytes from %s" % (offset, url))
+        buffer.close()
+
+    except DownloadAborted:
+        pass
+    except Exception as e:
+        buffer.close(e)
+
+
+def stream_lines(url: str, chunk_size: int, max_memory: int, max_retries: int):
+    """
+    Yield the lines of a (possibly gzip/lz4/zstd compressed) NDJSON file while it is being downloaded
+    """
+    buffer = SpillBuffer(max_memory, read_size=chunk_size)
+    Thread(target=_download, args=(url, buffer, chunk_size, max_retries), daemon=True).start()
+
+    try:
+        head = buffer.read()
+        while head and len(head) < 4:
+            chunk = buffer.read()
+            if not chunk:
+                break
+            head += chunk
+
+        decompressor = _make_decompressor(head)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = ""
+
+        chunk = head
+        while chunk:
+            text = pending + decoder.decode(decompressor.decompress(chunk))
+            lines = text.split("\n")
+            pending = lines.pop()
+            for line in lines:
+                if line:
+                    yield line
+            chunk = buffer.read()
+
+        pending += decoder.decode(b"", final=True)
+        if pending:
+            yield pending
+    finally:
+        buffer.abort()
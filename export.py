@@ -1,12 +1,30 @@
+import argparse
 import os
+import shutil
 import time
+from multiprocessing import Pool, Value
+from multiprocessing.pool import ThreadPool
+from queue import Queue
+from threading import Thread, local, Semaphore
 
 import lz4.frame
+import redis
+import ujson
 
 import config
 from database import Database
+from search.generations import GenerationStore
+from search.links import website_root
 from search.search import ElasticSearchEngine
 
+FIELDS = ["website_id", "website_url", "path", "name", "ext", "size", "mtime"]
+ROWS_PER_CHUNK = 5000
+# Small websites are grouped together until a parquet row group has at least this many rows
+MIN_ROW_GROUP_SIZE = 1000000
+
+dldir = "static/downloads/"
+workdir = "export_parts/"
+
 
 def quote(string):
     if "\"" in string:
@@ -17,47 +35,301 @@ def quote(string):
         return string
 
 
-outfile = time.strftime("%Y-%m-%d_%H:%M:%S_dump.csv.lz4", time.gmtime())
-dldir = "static/downloads/"
+def format_row(src, website_url) -> bytes:
+    return (",".join(
+        [
+            str(src["website_id"]),
+            quote(website_url),
+            quote(src["path"]),
+            quote(src["name"]),
+            quote(src["ext"]),
+            str(src["size"]),
+            str(src["mtime"])
+        ]
+    ) + "\n").encode()
+
+
+def connect_es() -> ElasticSearchEngine:
+    # Hidden and retired generations are excluded from the dumps
+    generations = GenerationStore(redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT))
+    return ElasticSearchEngine(config.ES_URL, config.ES_INDEX, generations=generations)
+
+
+def open_lz4(path):
+    return lz4.frame.open(path, mode='wb', compression_level=9, block_size=lz4.frame.BLOCKSIZE_MAX4MB)
 
-print("Deleting existing dumps")
-for file in os.listdir(dldir):
-    if file.endswith("_dump.csv.lz4"):
-        os.remove(os.path.join(dldir, file))
 
-print("Export started, connecting to databases...")
+def slice_path(slice_id):
+    return os.path.join(workdir, "slice_%d.csv.lz4" % slice_id)
 
-db = Database(config.DB_CONN_STR)
-es = ElasticSearchEngine(config.ES_URL, config.ES_INDEX)
 
-docs_with_url = db.join_website_url(es.stream_all_docs())
+# Set in each worker process by init_worker()
+website_roots = None
+exported_count = None
 
-print("Connected, writing to csv")
 
-with lz4.frame.open(outfile + ".part", mode='wb',
-                    compression_level=9,
-                    block_size=lz4.frame.BLOCKSIZE_MAX4MB) as fp:
-    fp.write((",".join(
-        ["website_id", "website_url", "path", "name", "ext", "size", "mtime"]
-    ) + "\n").encode())
+def init_worker(roots, counter):
+    global website_roots, exported_count
+    website_roots = roots
+    exported_count = counter
 
-    for doc in docs_with_url:
+
+def export_slice(args):
+    """
+    Export one slice of the index to its own lz4 file. Scrolling, formatting and compression
+    run concurrently: scroll thread -> (this thread) row formatting -> compression thread
+    """
+    slice_id, slices = args
+
+    es = connect_es()
+    hits_queue = Queue(maxsize=4)
+    chunks_queue = Queue(maxsize=4)
+    errors = []
+
+    def read_hits():
+        try:
+            batch = []
+            for doc in es.stream_all_docs(slice_id, slices):
+                batch.append(doc)
+                if len(batch) >= ROWS_PER_CHUNK:
+                    hits_queue.put(batch)
+                    batch = []
+            hits_queue.put(batch)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            hits_queue.put(None)
+
+    def compress():
         try:
-            fp.write(
-                (",".join(
-                    [
-                        str(doc["_source"]["website_id"]),
-                        quote(doc["_source"]["website_url"]),
-                        quote(doc["_source"]["path"]),
-                        quote(doc["_source"]["name"]),
-                        quote(doc["_source"]["ext"]),
-                        str(doc["_source"]["size"]),
-                        str(doc["_source"]["mtime"])
-                    ]
-                ) + "\n").encode())
+            with open_lz4(slice_path(slice_id) + ".part") as fp:
+                chunk = chunks_queue.get()
+                while chunk is not None:
+                    fp.write(chunk)
+                    chunk = chunks_queue.get()
         except Exception as e:
-            print(e)
-            print(doc)
+            errors.append(e)
+            # Keep consuming so that the formatting stage does not block
+            while chunks_queue.get() is not None:
+                pass
+
+    reader = Thread(target=read_hits)
+    writer = Thread(target=compress)
+    reader.start()
+    writer.start()
+
+    batch = hits_queue.get()
+    while batch is not None:
+        rows = []
+        for doc in batch:
+            try:
+                src = doc["_source"]
+                root = src.get("website_url") or website_roots.get(src["website_id"], "[DELETED]")
+                rows.append(format_row(src, root))
+            except Exception as e:
+                print(e)
+                print(doc)
+        chunks_queue.put(b"".join(rows))
+
+        with exported_count.get_lock():
+            exported_count.value += len(batch)
+        batch = hits_queue.get()
+
+    chunks_queue.put(None)
+    reader.join()
+    writer.join()
+
+    if errors:
+        raise errors[0]
+
+    os.rename(slice_path(slice_id) + ".part", slice_path(slice_id))
+    return slice_id
+
+
+def load_state(slices):
+    """Resume the previous export if it was interrupted, otherwise start a new one"""
+    state_file = os.path.join(workdir, "export.json")
+
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = ujson.load(f)
+        if state["slices"] == slices:
+            done = [i for i in range(slices) if os.path.exists(slice_path(i))]
+            print("Resuming export of %s (%d/%d slices done)" % (state["outfile"], len(done), slices))
+            return state, done
+
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+
+    state = {
+        "outfile": time.strftime("%Y-%m-%d_%H:%M:%S_dump.csv.lz4", time.gmtime()),
+        "slices": slices,
+    }
+    with open(state_file, "w") as f:
+        ujson.dump(state, f)
+
+    print("Deleting existing dumps")
+    for file in os.listdir(dldir):
+        if file.endswith("_dump.csv.lz4"):
+            os.remove(os.path.join(dldir, file))
+
+    return state, []
+
+
+def report_progress(counter, total, start):
+    while True:
+        time.sleep(30)
+        elapsed = time.time() - start
+        print("Exported %d/%d docs (%.0f docs/s)" % (counter.value, total, counter.value / elapsed))
+
+
+def main(slices):
+    state, done = load_state(slices)
+    outfile = state["outfile"]
+
+    print("Export started, connecting to databases...")
 
+    es = connect_es()
 
-os.rename(outfile + ".part", os.path.join(dldir, outfile))
+    # The website map is only needed for the documents indexed without their website url
+    if es.count_docs_without_website_url():
+        roots = Database(config.DB_CONN_STR).get_website_roots()
+    else:
+        roots = dict()
+    todo = [(i, slices) for i in range(slices) if i not in done]
+
+    print("Connected, writing %d slices to csv" % len(todo))
+
+    counter = Value("q", 0)
+    progress = Thread(target=report_progress, args=(counter, es.count_all_docs(), time.time()), daemon=True)
+    progress.start()
+
+    with Pool(processes=max(1, len(todo)), initializer=init_worker, initargs=(roots, counter)) as pool:
+        for slice_id in pool.imap_unordered(export_slice, todo):
+            done.append(slice_id)
+            print("Slice %d done (%d/%d)" % (slice_id, len(done), slices))
+
+    # Concatenated lz4 frames decompress to the concatenation of their contents
+    with open(os.path.join(workdir, outfile + ".part"), "wb") as out:
+        with open_lz4(out) as fp:
+            fp.write((",".join(FIELDS) + "\n").encode())
+        for i in range(slices):
+            with open(slice_path(i), "rb") as f:
+                shutil.copyfileobj(f, out, 4 * 1024 * 1024)
+
+    os.rename(os.path.join(workdir, outfile + ".part"), os.path.join(dldir, outfile))
+    shutil.rmtree(workdir)
+    print("Export done: " + outfile)
+
+
+# Set in each thread of the parquet export by init_fetch_thread()
+fetch_state = local()
+
+
+def init_fetch_thread():
+    fetch_state.es = connect_es()
+
+
+def fetch_website_table(args):
+    """All documents of a website as an arrow table (one website_url dictionary entry)"""
+    import pyarrow as pa
+
+    website_id, website_root, schema = args
+
+    paths, names, exts, sizes, mtimes = [], [], [], [], []
+    for doc in fetch_state.es.stream_website_docs(website_id):
+        src = doc["_source"]
+        paths.append(src["path"])
+        names.append(src["name"])
+        exts.append(src["ext"])
+        sizes.append(src.get("size"))
+        mtimes.append(src.get("mtime"))
+
+    return pa.Table.from_arrays([
+        pa.array([website_id] * len(paths), type=pa.int32()),
+        pa.DictionaryArray.from_arrays(pa.array([0] * len(paths), type=pa.int32()), pa.array([website_root])),
+        pa.array(paths, type=pa.string()),
+        pa.array(names, type=pa.string()),
+        pa.array(exts, type=pa.string()).dictionary_encode(),
+        pa.array(sizes, type=pa.int64()),
+        pa.array(mtimes, type=pa.timestamp("s")),
+    ], schema=schema)
+
+
+def export_parquet(threads):
+    """
+    Columnar dump, sorted by website_id: each row group holds one or more whole websites, so readers
+    can select a website with the row group statistics and read only the columns they need.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    outfile = time.strftime("%Y-%m-%d_%H:%M:%S_dump.parquet", time.gmtime())
+    schema = pa.schema([
+        ("website_id", pa.int32()),
+        ("website_url", pa.dictionary(pa.int32(), pa.string())),
+        ("path", pa.string()),
+        ("name", pa.string()),
+        ("ext", pa.dictionary(pa.int32(), pa.string())),
+        ("size", pa.int64()),
+        ("mtime", pa.timestamp("s")),
+    ])
+
+    print("Export started, connecting to databases...")
+    db = Database(config.DB_CONN_STR)
+    websites = sorted(db.get_all_websites().items())
+    print("Connected, writing %d websites to parquet" % len(websites))
+
+    buffer = []
+    buffered_rows = 0
+    exported = 0
+    start = time.time()
+
+    # Fetched tables waiting for the writer, imap would otherwise fetch every website ahead of it
+    in_flight = Semaphore(threads * 2)
+
+    def fetch_args():
+        for website_id, url in websites:
+            in_flight.acquire()
+            yield website_id, website_root(url), schema
+
+    with pq.ParquetWriter(outfile + ".part", schema, compression="zstd") as writer, \
+            ThreadPool(threads, initializer=init_fetch_thread) as pool:
+        for i, table in enumerate(pool.imap(fetch_website_table, fetch_args())):
+            in_flight.release()
+            if table.num_rows == 0:
+                continue
+            buffer.append(table)
+            buffered_rows += table.num_rows
+
+            if buffered_rows >= MIN_ROW_GROUP_SIZE:
+                writer.write_table(pa.concat_tables(buffer), row_group_size=buffered_rows)
+                exported += buffered_rows
+                buffer = []
+                buffered_rows = 0
+                print("Exported %d docs, %d/%d websites (%.0f docs/s)"
+                      % (exported, i + 1, len(websites), exported / (time.time() - start)))
+
+        if buffer:
+            writer.write_table(pa.concat_tables(buffer), row_group_size=buffered_rows)
+
+    print("Deleting existing parquet dumps")
+    for file in os.listdir(dldir):
+        if file.endswith("_dump.parquet"):
+            os.remove(os.path.join(dldir, file))
+
+    os.rename(outfile + ".part", os.path.join(dldir, outfile))
+    print("Export done: " + outfile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the database to static/downloads/")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--slices", type=int, default=config.EXPORT_SLICES,
+                        help="Number of parallel scrolls (csv) or website fetching threads (parquet)")
+    cli_args = parser.parse_args()
+
+    if cli_args.format == "parquet":
+        export_parquet(cli_args.slices)
+    else:
+        main(cli_args.slices)
@@ -0,0 +1,9 @@
+import time
+
+from tasks import TaskManager
+
+tm = TaskManager()
+tm.start_indexer_threads()
+
+while True:
+    time.sleep(60)
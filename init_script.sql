@@ -1,4 +1,4 @@
-DROP TABLE IF EXISTS Website, Admin, BlacklistedWebsite, ApiClient, SearchLogEntry;
+DROP TABLE IF EXISTS Website, Admin, BlacklistedWebsite, ApiClient, SearchLogEntry, WebsiteStats, CrawlHistory;
 
 CREATE TABLE Website (
 
@@ -6,9 +6,46 @@ CREATE TABLE Website (
   url TEXT,
   logged_ip TEXT,
   logged_useragent TEXT,
-  last_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+  last_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  netloc TEXT
 );
 
+-- Lowercase host[:port] of the url, kept up to date by a trigger so that it is always
+-- computed the same way as in Database.website_exists()
+CREATE OR REPLACE FUNCTION url_netloc(url TEXT) RETURNS TEXT AS $$
+  SELECT lower(substring(url from '^[a-zA-Z][a-zA-Z0-9+.-]*://([^/?#]*)'))
+$$ LANGUAGE SQL IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION website_set_netloc() RETURNS TRIGGER AS $$
+BEGIN
+  NEW.netloc := url_netloc(NEW.url);
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER website_netloc_trigger BEFORE INSERT OR UPDATE OF url ON Website
+  FOR EACH ROW EXECUTE PROCEDURE website_set_netloc();
+
+-- Keeps the WebsiteMap of every process up to date, payload: <operation> <id>, listeners read the url
+CREATE OR REPLACE FUNCTION website_notify() RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    PERFORM pg_notify('website_changes', 'DELETE ' || OLD.id);
+  ELSE
+    PERFORM pg_notify('website_changes', TG_OP || ' ' || NEW.id);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER website_notify_trigger AFTER INSERT OR DELETE OR UPDATE OF url ON Website
+  FOR EACH ROW EXECUTE PROCEDURE website_notify();
+
+CREATE INDEX website_netloc ON Website (netloc);
+-- Used by url LIKE 'prefix%' queries regardless of the collation
+CREATE INDEX website_url_pattern ON Website (url text_pattern_ops);
+CREATE INDEX website_last_modified ON Website (last_modified);
+
 CREATE TABLE Admin (
   username TEXT PRIMARY KEY NOT NULL,
   password BYTEA,
@@ -37,3 +74,22 @@ CREATE TABLE SearchLogEntry (
   results INT DEFAULT 0,
   took INT DEFAULT 0
 );
+
+CREATE TABLE WebsiteStats (
+  website_id INT PRIMARY KEY REFERENCES Website(id) ON DELETE CASCADE,
+  last_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  stats JSONB
+);
+
+CREATE TABLE CrawlHistory (
+  id SERIAL PRIMARY KEY,
+  website_id INT REFERENCES Website(id) ON DELETE CASCADE,
+  crawl_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  elapsed REAL,
+  file_count BIGINT,
+  total_size BIGINT,
+  changed REAL,
+  duration REAL
+);
+
+CREATE INDEX crawl_history_website_id_crawl_time ON CrawlHistory (website_id, crawl_time);
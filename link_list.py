@@ -0,0 +1,146 @@
+import fcntl
+import glob
+import gzip
+import os
+import re
+import zlib
+from contextlib import contextmanager
+from uuid import uuid4
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class LinkListCache:
+    """
+    Link lists of websites, stored on disk as gzip files. A file is generated the first time the
+    list is requested after a crawl, while the list is streamed to that first client. Concurrent
+    requests for the same website wait for it and are served from the file.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, search, directory):
+        self.search = search
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, website) -> str:
+        # last_modified changes every time the website is indexed
+        version = re.sub(r"\D", "", str(website.last_modified))
+        return os.path.join(self.directory, "%s_%s.txt.gz" % (website.id, version))
+
+    def get_encodings(self, cached: bool) -> list:
+        """Content-Encodings that can be served, in order of preference"""
+        if cached or not zstandard:
+            return ["gzip"]
+        return ["gzip", "zstd"]
+
+    def delete(self, website_id: int):
+        for path in glob.glob(os.path.join(self.directory, "%d_*.txt.gz" % website_id)):
+            os.remove(path)
+
+    def read(self, path):
+        """Decompressed content of a cached list, for clients that do not accept gzip"""
+        with gzip.open(path, "rb") as f:
+            chunk = f.read(LinkListCache.CHUNK_SIZE)
+            while chunk:
+                yield chunk
+                chunk = f.read(LinkListCache.CHUNK_SIZE)
+
+    @contextmanager
+    def _lock(self, website_id: int):
+        """Lock on the list of a website, shared by the threads and the uwsgi workers"""
+        with open(os.path.join(self.directory, "%d.lock" % website_id), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_encoded(self, path, encoding: str = None):
+        if encoding == "gzip":
+            with open(path, "rb") as f:
+                chunk = f.read(LinkListCache.CHUNK_SIZE)
+                while chunk:
+                    yield chunk
+                    chunk = f.read(LinkListCache.CHUNK_SIZE)
+        elif encoding == "zstd":
+            compressor = zstandard.ZstdCompressor().compressobj()
+            for chunk in self.read(path):
+                yield compressor.compress(chunk)
+            yield compressor.flush()
+        else:
+            yield from self.read(path)
+
+    def stream(self, website, encoding: str = None):
+        """Generate the list from ES, yield it in the requested encoding and save it on disk"""
+        path = self.get_path(website)
+
+        with self._lock(website.id):
+            if os.path.exists(path):
+                # Generated by another request while this one was waiting
+                yield from self._read_encoded(path, encoding)
+            else:
+                yield from self._generate(website, path, encoding)
+
+    def _generate(self, website, path, encoding: str = None):
+        tmp_path = path + "." + uuid4().hex + ".part"
+
+        gzip_compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        zstd_compressor = zstandard.ZstdCompressor().compressobj() if encoding == "zstd" else None
+
+        def encode(data, gz):
+            if encoding == "gzip":
+                return gz
+            if zstd_compressor:
+                return zstd_compressor.compress(data)
+            return data
+
+        completed = False
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in self._iter_chunks(self.search.get_link_list(website.id, website.url)):
+                    data = chunk.encode()
+                    gz = gzip_compressor.compress(data)
+                    f.write(gz)
+
+                    out = encode(data, gz)
+                    if out:
+                        yield out
+
+                gz = gzip_compressor.flush()
+                f.write(gz)
+
+            if encoding == "gzip":
+                yield gz
+            elif zstd_compressor:
+                yield zstd_compressor.flush()
+
+            self.delete(website.id)
+            os.replace(tmp_path, path)
+            completed = True
+        finally:
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def _iter_chunks(links):
+        """Newline-separated links (no trailing newline), in chunks of about CHUNK_SIZE characters"""
+        buf = []
+        size = 0
+        separator = ""
+        for link in links:
+            buf.append(separator)
+            buf.append(link)
+            separator = "\n"
+            size += len(link) + 1
+
+            if size >= LinkListCache.CHUNK_SIZE:
+                yield "".join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield "".join(buf)
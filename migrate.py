@@ -0,0 +1,20 @@
+import config
+from database import Database
+from search.search import ElasticSearchEngine
+
+# Apply migrations.sql to an existing database and add the new fields to the ES index mapping, once
+# per update. The web app, the indexer and the submission worker do not run migrations themselves.
+db = Database(config.DB_CONN_STR)
+print("Applying migrations.sql")
+db.migrate_database()
+print("Database migrations done")
+
+es = ElasticSearchEngine(config.ES_URL, config.ES_INDEX)
+print("Updating index mapping")
+es.update_mapping()
+print("Index mapping updated")
+
+missing = es.count_docs_without_file_id()
+if missing:
+    # Search API cursors sort on file_id
+    print("%d documents have no file id, run backfill_website_url.py" % missing)
@@ -0,0 +1,75 @@
+-- Applied on existing databases by migrate.py, every statement must be idempotent
+
+-- Concurrent runs wait for each other instead of racing on the functions and triggers
+SELECT pg_advisory_xact_lock(5020);
+
+CREATE TABLE IF NOT EXISTS WebsiteStats (
+  website_id INT PRIMARY KEY REFERENCES Website(id) ON DELETE CASCADE,
+  last_modified TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  stats JSONB
+);
+
+CREATE TABLE IF NOT EXISTS CrawlHistory (
+  id SERIAL PRIMARY KEY,
+  website_id INT REFERENCES Website(id) ON DELETE CASCADE,
+  crawl_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  elapsed REAL,
+  file_count BIGINT,
+  total_size BIGINT,
+  changed REAL,
+  duration REAL
+);
+
+CREATE INDEX IF NOT EXISTS crawl_history_website_id_crawl_time ON CrawlHistory (website_id, crawl_time);
+
+ALTER TABLE Website ADD COLUMN IF NOT EXISTS netloc TEXT;
+
+-- Lowercase host[:port] of the url, kept up to date by a trigger so that it is always
+-- computed the same way as in Database.website_exists()
+CREATE OR REPLACE FUNCTION url_netloc(url TEXT) RETURNS TEXT AS $$
+  SELECT lower(substring(url from '^[a-zA-Z][a-zA-Z0-9+.-]*://([^/?#]*)'))
+$$ LANGUAGE SQL IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION website_set_netloc() RETURNS TRIGGER AS $$
+BEGIN
+  NEW.netloc := url_netloc(NEW.url);
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'website_netloc_trigger') THEN
+    CREATE TRIGGER website_netloc_trigger BEFORE INSERT OR UPDATE OF url ON Website
+      FOR EACH ROW EXECUTE PROCEDURE website_set_netloc();
+  END IF;
+END
+$$;
+
+UPDATE Website SET netloc = url_netloc(url) WHERE netloc IS NULL AND url IS NOT NULL;
+
+-- Keeps the WebsiteMap of every process up to date, payload: <operation> <id>, listeners read the url
+CREATE OR REPLACE FUNCTION website_notify() RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    PERFORM pg_notify('website_changes', 'DELETE ' || OLD.id);
+  ELSE
+    PERFORM pg_notify('website_changes', TG_OP || ' ' || NEW.id);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'website_notify_trigger') THEN
+    CREATE TRIGGER website_notify_trigger AFTER INSERT OR DELETE OR UPDATE OF url ON Website
+      FOR EACH ROW EXECUTE PROCEDURE website_notify();
+  END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS website_netloc ON Website (netloc);
+-- Used by url LIKE 'prefix%' queries regardless of the collation
+CREATE INDEX IF NOT EXISTS website_url_pattern ON Website (url text_pattern_ops);
+CREATE INDEX IF NOT EXISTS website_last_modified ON Website (last_modified);
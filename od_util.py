@@ -1,11 +1,16 @@
+import html
 import os
 import re
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from ftplib import FTP
+from threading import Lock
 from urllib.parse import urljoin, urlparse
 
 import requests
 import validators
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 # TODO: find a better way to do this
 try:
@@ -172,7 +177,150 @@ def is_external_link(base_url, url: str):
     return True
 
 
-def is_od(url):
+# Pages larger than this are truncated, the tags counted by is_od() are near the top anyway
+MAX_PAGE_SIZE = 4 * 1024 * 1024
+# Failed fetches are cached for a shorter time
+ERROR_TTL = 60
+# Maximum number of parent directories walked up by get_top_directory()
+MAX_PARENT_DEPTH = 16
+
+ANCHOR_HREF_RE = re.compile(r"<a\s[^>]*?\bhref\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+))", re.IGNORECASE)
+LINK_TAG_RE = re.compile(r"<link\b", re.IGNORECASE)
+SCRIPT_TAG_RE = re.compile(r"<script\b", re.IGNORECASE)
+
+
+class Page:
+    """What is_od() needs to know about a fetched page"""
+
+    def __init__(self, status_code: int, links=(), link_tags=0, script_tags=0):
+        self.status_code = status_code
+        self.links = links
+        self.link_tags = link_tags
+        self.script_tags = script_tags
+
+    @staticmethod
+    def parse(status_code: int, text: str):
+        """Extract the href of anchors and count link/script tags without building a document tree"""
+        links = [html.unescape(m.group(1) or m.group(2) or m.group(3) or "") for m in ANCHOR_HREF_RE.finditer(text)]
+        return Page(status_code, links, len(LINK_TAG_RE.findall(text)), len(SCRIPT_TAG_RE.findall(text)))
+
+
+class PageFetcher:
+    """
+    Fetches pages through a shared session. Results are cached for ttl seconds and concurrent
+    fetches of the same url wait for the same request.
+    """
+
+    def __init__(self, timeout=30, ttl=600, threads=8, cache_size=10000):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.cache_size = cache_size
+
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._lock = Lock()
+        self._cache = OrderedDict()
+        self._pending = dict()
+
+        self.hits = 0
+        self.fetches = 0
+        self.errors = 0
+
+    def get(self, url):
+        """Returns a Page, or None if the url could not be fetched"""
+
+        with self._lock:
+            cached = self._cache.get(url)
+            if cached and cached[0] > time.time():
+                self._cache.move_to_end(url)
+                self.hits += 1
+                return cached[1]
+
+            future = self._pending.get(url)
+            fetch = future is None
+            if fetch:
+                future = Future()
+                self._pending[url] = future
+                self.fetches += 1
+            else:
+                self.hits += 1
+        if not fetch:
+            return future.result()
+
+        try:
+            page = self._fetch(url)
+        except Exception:
+            page = None
+
+        with self._lock:
+            if page is None:
+                self.errors += 1
+            self._cache[url] = (time.time() + (self.ttl if page else ERROR_TTL), page)
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            del self._pending[url]
+
+        future.set_result(page)
+        return page
+
+    def get_many(self, urls) -> list:
+        """Fetch the urls concurrently"""
+        return list(self._executor.map(self.get, urls))
+
+    def _fetch(self, url):
+        with self.session.get(url, timeout=self.timeout, allow_redirects=False, stream=True) as r:
+            if r.status_code != 200:
+                return Page(r.status_code)
+
+            body = bytearray()
+            for chunk in r.iter_content(chunk_size=65536):
+                body += chunk
+                if len(body) >= MAX_PAGE_SIZE:
+                    break
+            return Page.parse(r.status_code, body.decode(r.encoding or "utf-8", errors="replace"))
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "fetches": self.fetches,
+                "errors": self.errors,
+                "cached": len(self._cache),
+            }
+
+
+fetcher = PageFetcher(timeout=config.OD_CHECK_TIMEOUT, ttl=config.OD_CHECK_CACHE_TTL,
+                      threads=config.OD_CHECK_THREADS)
+
+
+def looks_like_od(url, page: Page) -> bool:
+    if not page or page.status_code != 200:
+        return False
+
+    external_links = sum(1 if is_external_link(url, href) else 0 for href in page.links)
+
+    if external_links > 11:
+        # print("Too many external links!")
+        return False
+
+    if page.link_tags > 5:
+        # print("Too many link tags!")
+        return False
+
+    if page.script_tags > 7:
+        # print("Too many script tags!")
+        return False
+
+    return True
+
+
+def is_od(url, page_fetcher: PageFetcher = None):
     if not url.endswith("/"):
         print("Url does not end with trailing /")
         return False
@@ -184,36 +332,15 @@ def is_od(url):
             ftp.close()
             return True
         elif config.SUBMIT_HTTP:
-            r = requests.get(url, timeout=30, allow_redirects=False, verify=False)
-            if r.status_code != 200:
-                # print("No redirects allowed!")
-                return False
-            soup = BeautifulSoup(r.text, "lxml")
-
-            external_links = sum(1 if is_external_link(url, a.get("href")) else 0 for a in soup.find_all("a"))
-            link_tags = len(list(soup.find_all("link")))
-            script_tags = len(list(soup.find_all("script")))
-
-            if external_links > 11:
-                # print("Too many external links!")
-                return False
-
-            if link_tags > 5:
-                # print("Too many link tags!")
-                return False
-
-            if script_tags > 7:
-                # print("Too many script tags!")
-                return False
-
-            return True
+            return looks_like_od(url, (page_fetcher or fetcher).get(url))
 
     except Exception as e:
         # print(e)
         return False
 
 
-def has_parent_dir(url):
+def has_parent_dir(url, page_fetcher: PageFetcher = None):
+    page_fetcher = page_fetcher or fetcher
 
     parsed_url = urlparse(url)
 
@@ -222,15 +349,14 @@ def has_parent_dir(url):
 
     parent_url = urljoin(url, "../")
     try:
-        r = requests.get(parent_url, timeout=30, allow_redirects=False, verify=False)
-        if r.status_code != 200:
+        page = page_fetcher.get(parent_url)
+        if not page or page.status_code != 200:
             return False
-        soup = BeautifulSoup(r.text, "lxml")
 
-        for anchor in soup.find_all("a"):
-            if anchor.get("href") and anchor.get("href").endswith("/") and urljoin(parent_url, anchor.get("href")) == url:
+        for href in page.links:
+            if href.endswith("/") and urljoin(parent_url, href) == url:
                 # The parent page exists, and has a link to the child directory
-                return is_od(parent_url)
+                return is_od(parent_url, page_fetcher)
 
     except:
         return False
@@ -239,10 +365,18 @@ def has_parent_dir(url):
     return False
 
 
-def get_top_directory(url):
+def get_top_directory(url, page_fetcher: PageFetcher = None):
     if url.startswith("ftp://"):
         return url
 
-    while has_parent_dir(url):
+    page_fetcher = page_fetcher or fetcher
+    # The url (checked by is_od() afterwards) and its parent are always needed, the other parents
+    # are only fetched when the walk reaches them
+    if urlparse(url).path not in ("/", ""):
+        page_fetcher.get_many([url, urljoin(url, "../")])
+
+    depth = 0
+    while depth < MAX_PARENT_DEPTH and has_parent_dir(url, page_fetcher):
         url = urljoin(url, "../")
+        depth += 1
     return url
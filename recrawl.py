@@ -0,0 +1,170 @@
+import logging
+import math
+import time
+
+import config
+
+logger = logging.getLogger("default")
+
+DAY = 24 * 3600
+# Floor of the unchanged fraction of a crawl, a website that changed completely has a finite change rate
+MIN_UNCHANGED = 0.001
+
+
+class SiteEstimate:
+    """What the crawl history of a website tells about its next re-crawl"""
+
+    def __init__(self, website, last_crawl: float, rate, files: int, interval: float):
+        self.website = website
+        self.last_crawl = last_crawl
+        # Estimated fraction of the files that change per day, None when unknown
+        self.rate = rate
+        self.files = files
+        self.interval = interval
+
+    def due(self, now: float) -> float:
+        """>= 1 when the website should be re-crawled"""
+        return (now - self.last_crawl) / self.interval
+
+
+class RecrawlScheduler:
+    """
+    Re-crawls websites at an interval adapted to how often their files change, as recorded
+    in CrawlHistory, stretched for large websites. Each run picks the most overdue websites
+    that fit in a budget of files to crawl and index.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.min_interval = config.RECRAWL_MIN_INTERVAL * DAY
+        self.max_interval = config.RECRAWL_MAX_INTERVAL * DAY
+        self.default_interval = config.RECRAWL_DEFAULT_INTERVAL * DAY
+        self.target_change = config.RECRAWL_TARGET_CHANGE
+        self.large_site = config.RECRAWL_LARGE_SITE
+        self.budget = config.RECRAWL_BUDGET
+        self.max_tasks = int(config.RECRAWL_POOL_SIZE)
+
+    @staticmethod
+    def change_rate(history: list):
+        """
+        Exponentially weighted change rate (per day) of a website, None if its
+        history has no incremental crawl
+        """
+        rate = None
+        for crawl_time, elapsed, file_count, total_size, changed, duration in history:
+            if changed is None or not elapsed or elapsed <= 0:
+                continue
+            crawl_rate = -math.log(max(1 - changed, MIN_UNCHANGED)) / (elapsed / DAY)
+            rate = crawl_rate if rate is None else 0.5 * rate + 0.5 * crawl_rate
+        return rate
+
+    def interval(self, rate, files: int) -> float:
+        if rate is None:
+            interval = self.default_interval
+        elif rate <= 0:
+            interval = self.max_interval
+        else:
+            # Time until the expected fraction of changed files reaches the target
+            interval = -math.log(1 - self.target_change) / rate * DAY
+
+        if files > self.large_site:
+            interval *= 1 + math.log10(files / self.large_site)
+
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def estimate(self, website, history: list) -> SiteEstimate:
+        files = history[-1][2] if history else 0
+        rate = self.change_rate(history)
+        return SiteEstimate(website, website.last_modified.timestamp(), rate, files or 0,
+                            self.interval(rate, files or 0))
+
+    def get_estimates(self, prefix="http") -> list:
+        return [self.estimate(website, history) for website, history
+                in self.db.get_crawl_histories(prefix, config.RECRAWL_HISTORY_SIZE)]
+
+    def plan(self, estimates: list, now: float = None) -> list:
+        """Most overdue websites first, within the budget of files and tasks"""
+        now = now or time.time()
+
+        due = [e for e in estimates if e.due(now) >= 1]
+        due.sort(key=lambda e: e.due(now), reverse=True)
+
+        queue = []
+        files = 0
+        for e in due:
+            if len(queue) >= self.max_tasks:
+                break
+            if queue and files + e.files > self.budget:
+                # Smaller websites may still fit
+                continue
+            queue.append(e)
+            files += e.files
+
+        logger.info("Re-crawl plan: %d/%d websites due, %d queued (%d files)"
+                    % (len(due), len(estimates), len(queue), files))
+        return queue
+
+    def get_queue(self, prefix="http") -> list:
+        return self.plan(self.get_estimates(prefix))
+
+    def simulate(self, estimates: list, days: int) -> dict:
+        """
+        Replay days of re-crawls, with websites changing at the rate estimated from their
+        history, under this schedule and under the oldest-first schedule with the same budget
+        """
+        now = time.time()
+        default_rate = -math.log(1 - self.target_change) / (self.default_interval / DAY)
+        initial = {e.website.id: e.last_crawl for e in estimates}
+
+        def run(pick):
+            last_crawl = dict(initial)
+            result = {"crawls": 0, "files_crawled": 0, "changes_found": 0, "stale_files": 0}
+
+            for day in range(1, days + 1):
+                t = now + day * DAY
+                for e in pick(estimates, last_crawl, t):
+                    rate = default_rate if e.rate is None else e.rate
+                    elapsed = (t - last_crawl[e.website.id]) / DAY
+                    result["crawls"] += 1
+                    result["files_crawled"] += e.files
+                    result["changes_found"] += e.files * (1 - math.exp(-rate * elapsed))
+                    last_crawl[e.website.id] = t
+
+                # Files that changed since the last crawl of their website, at the end of the day
+                for e in estimates:
+                    rate = default_rate if e.rate is None else e.rate
+                    result["stale_files"] += e.files * (1 - math.exp(-rate * (t - last_crawl[e.website.id]) / DAY))
+
+            result["stale_files"] /= days
+            result["files_per_change"] = result["files_crawled"] / result["changes_found"] \
+                if result["changes_found"] else None
+            return result
+
+        def adaptive(estimates, last_crawl, t):
+            for e in estimates:
+                e.last_crawl = last_crawl[e.website.id]
+            return self.plan(estimates, t)
+
+        def oldest_first(estimates, last_crawl, t):
+            queue = []
+            files = 0
+            for e in sorted(estimates, key=lambda e: last_crawl[e.website.id]):
+                if len(queue) >= self.max_tasks:
+                    break
+                if queue and files + e.files > self.budget:
+                    continue
+                queue.append(e)
+                files += e.files
+            return queue
+
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            return {
+                "adaptive": run(adaptive),
+                "oldest_first": run(oldest_first),
+            }
+        finally:
+            logger.setLevel(level)
+            for e in estimates:
+                e.last_crawl = initial[e.website.id]
@@ -0,0 +1,221 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Condition
+
+import ujson
+
+from search import logger
+
+BULK_MAX_BYTES = 10 * 1024 * 1024
+BULK_IN_FLIGHT = 4
+BULK_MAX_RETRIES = 5
+
+
+class BulkThrottle:
+    """
+    Shared by the BulkIndexers of all indexer threads: bounds the total size of the
+    in-flight bulk requests and records their latency and rejections.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._cond = Condition()
+        self._in_flight = 0
+
+        self._requests = 0
+        self._latency = 0
+        self._max_latency = 0
+        self._rejections = 0
+
+    def acquire(self, size: int) -> int:
+        """Block until size bytes fit in the budget, returns the amount to release()"""
+        size = min(size, self.max_bytes)
+        with self._cond:
+            while self._in_flight + size > self.max_bytes:
+                self._cond.wait()
+            self._in_flight += size
+        return size
+
+    def release(self, size: int):
+        with self._cond:
+            self._in_flight -= size
+            self._cond.notify_all()
+
+    def record(self, latency: float, rejections: int = 0):
+        with self._cond:
+            self._requests += 1
+            self._latency += latency
+            self._max_latency = max(self._max_latency, latency)
+            self._rejections += rejections
+
+    def get_window(self) -> dict:
+        """Stats of the requests completed since the last call"""
+        with self._cond:
+            window = {
+                "requests": self._requests,
+                "latency": self._latency / self._requests if self._requests else 0,
+                "max_latency": self._max_latency,
+                "rejections": self._rejections,
+                "in_flight_bytes": self._in_flight,
+            }
+            self._requests = 0
+            self._latency = 0
+            self._max_latency = 0
+            self._rejections = 0
+        return window
+
+    def get_in_flight(self) -> int:
+        with self._cond:
+            return self._in_flight
+
+
+class BulkIndexer:
+    """
+    Streams index/delete actions to the _bulk API in batches bounded by their serialized size.
+    Up to max_in_flight requests run concurrently, add() blocks when they are all busy
+    or when the optional shared throttle is out of budget.
+    """
+
+    def __init__(self, es, index_name, routing, max_bytes=BULK_MAX_BYTES, max_in_flight=BULK_IN_FLIGHT,
+                 max_retries=BULK_MAX_RETRIES, throttle: BulkThrottle = None):
+        self.es = es
+        self.index_name = index_name
+        self.routing = routing
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.throttle = throttle
+
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._slots = BoundedSemaphore(max_in_flight)
+        self._futures = []
+
+        self._buf = []
+        self._buf_bytes = 0
+
+        self._lock = Lock()
+        self.indexed = 0
+        self.deleted = 0
+        self.failed = 0
+        self.requests = 0
+        self.rejections = 0
+
+    def add(self, doc: dict, doc_id: str = None):
+        if doc_id:
+            action = '{"index":{"_id":"' + doc_id + '"}}\n'
+        else:
+            action = '{"index":{}}\n'
+        self._append(action + ujson.dumps(doc) + "\n")
+
+    def delete(self, doc_id: str):
+        self._append('{"delete":{"_id":"' + doc_id + '"}}\n')
+
+    def _append(self, entry: str):
+        self._buf.append(entry)
+        self._buf_bytes += len(entry)
+
+        if self._buf_bytes >= self.max_bytes:
+            self._submit()
+
+    def _submit(self):
+        entries = self._buf
+        size = self._buf_bytes
+        self._buf = []
+        self._buf_bytes = 0
+
+        # Backpressure: wait until one of the in-flight requests completes
+        self._slots.acquire()
+        if self.throttle:
+            size = self.throttle.acquire(size)
+        future = self._executor.submit(self._send, entries)
+        future.add_done_callback(lambda _: self._done(size))
+        self._futures = [f for f in self._futures if not f.done()]
+        self._futures.append(future)
+
+    def _done(self, size: int):
+        if self.throttle:
+            self.throttle.release(size)
+        self._slots.release()
+
+    def _send(self, entries: list):
+        attempt = 0
+
+        while entries:
+            start = time.time()
+            try:
+                logger.debug("Sending " + str(len(entries)) + " bulk actions")
+                body = "".join(entries)
+                result = self.es.bulk(body=body, index=self.index_name, doc_type="file", request_timeout=30,
+                                      routing=self.routing)
+                with self._lock:
+                    self.requests += 1
+            except Exception as e:
+                if self.throttle:
+                    self.throttle.record(time.time() - start, 1 if getattr(e, "status_code", None) == 429 else 0)
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error("Giving up on bulk request of %d actions: %s" % (len(entries), e))
+                    self._count(failed=len(entries))
+                    return
+                logger.error("Error in bulk index: " + str(e) + ", retrying")
+                time.sleep(2 ** attempt)
+                continue
+
+            if not result["errors"]:
+                if self.throttle:
+                    self.throttle.record(time.time() - start)
+                deleted = sum(1 for entry in entries if entry.startswith('{"delete"'))
+                self._count(indexed=len(entries) - deleted, deleted=deleted)
+                return
+
+            retry = []
+            indexed = 0
+            deleted = 0
+            failed = 0
+            for entry, item in zip(entries, result["items"]):
+                op, item_result = next(iter(item.items()))
+                status = item_result["status"]
+                if op == "delete" and (status < 300 or status == 404):
+                    deleted += 1
+                elif status < 300:
+                    indexed += 1
+                elif status == 429:
+                    retry.append(entry)
+                else:
+                    failed += 1
+                    if failed == 1:
+                        logger.error("Error in ES bulk %s: %s for %s" % (op, item_result.get("error"), entry))
+            self._count(indexed=indexed, deleted=deleted, failed=failed, rejections=len(retry))
+            if self.throttle:
+                self.throttle.record(time.time() - start, len(retry))
+
+            entries = retry
+            if entries:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error("Giving up on %d actions rejected by ES" % len(entries))
+                    self._count(failed=len(entries))
+                    return
+                time.sleep(2 ** attempt)
+
+    def _count(self, indexed=0, deleted=0, failed=0, rejections=0):
+        with self._lock:
+            self.indexed += indexed
+            self.deleted += deleted
+            self.failed += failed
+            self.rejections += rejections
+
+    def close(self) -> dict:
+        """Send the remaining actions and wait for all requests to complete"""
+        if self._buf:
+            self._submit()
+        for future in self._futures:
+            future.result()
+        self._executor.shutdown()
+
+        return {
+            "indexed": self.indexed,
+            "deleted": self.deleted,
+            "failed": self.failed,
+            "requests": self.requests,
+            "rejections": self.rejections,
+        }
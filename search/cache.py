@@ -0,0 +1,86 @@
+import hashlib
+import time
+
+import ujson
+
+from search import logger
+
+
+class SearchCache:
+    """
+    Redis cache of search result pages (with the website urls already joined), keyed on the normalized
+    search parameters. Entries expire after ttl seconds, newly indexed files can take that long to show
+    up in cached pages. The entries that hold results of a website are dropped when the website is
+    re-indexed or deleted. Redis errors are logged and treated as misses, searches then go to ES.
+    """
+
+    WEBSITE = "oddb:search_cache:website:"
+    HITS = "oddb:search_cache:hits"
+    MISSES = "oddb:search_cache:misses"
+
+    def __init__(self, redis, ttl: int):
+        self.redis = redis
+        self.ttl = ttl
+
+    @staticmethod
+    def make_key(query, page, per_page, sort_order, extensions, size_min, size_max, match_all, fields, date_min,
+                 date_max) -> str:
+        params = [
+            query.strip(), int(page), int(per_page), sort_order,
+            sorted(set(extensions)) if extensions else [],
+            int(size_min or 0), int(size_max or 0),
+            bool(match_all), sorted(fields),
+            int(date_min or 0), int(date_max or 0),
+        ]
+        return "oddb:search_cache:" + hashlib.sha1(ujson.dumps(params).encode()).hexdigest()
+
+    def get(self, key: str):
+        if self.ttl <= 0:
+            return None
+
+        start = time.time()
+        try:
+            entry = self.redis.get(key)
+            self.redis.incr(SearchCache.HITS if entry else SearchCache.MISSES)
+        except Exception as e:
+            logger.error("Search cache lookup failed: %s" % e)
+            return None
+
+        if entry:
+            page = ujson.loads(entry)
+            # Time of this lookup, not of the ES query that filled the entry
+            page["took"] = int((time.time() - start) * 1000)
+            page["cached"] = True
+            return page
+        return None
+
+    def set(self, key: str, page: dict):
+        if self.ttl <= 0:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.setex(key, self.ttl, ujson.dumps(page))
+        for website_id in {hit["_source"]["website_id"] for hit in page["hits"]["hits"]}:
+            pipe.sadd(SearchCache.WEBSITE + str(website_id), key)
+            pipe.expire(SearchCache.WEBSITE + str(website_id), self.ttl)
+        try:
+            pipe.execute()
+        except Exception as e:
+            logger.error("Could not cache search results: %s" % e)
+
+    def invalidate_website(self, website_id: int):
+        """Drop the entries that hold results of a website, called when its documents changed"""
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.smembers(SearchCache.WEBSITE + str(website_id))
+        pipe.delete(SearchCache.WEBSITE + str(website_id))
+        keys, _ = pipe.execute()
+        if keys:
+            self.redis.delete(*keys)
+
+    def get_metrics(self) -> dict:
+        hits, misses = self.redis.mget(SearchCache.HITS, SearchCache.MISSES)
+        return {
+            "ttl": self.ttl,
+            "hits": int(hits or 0),
+            "misses": int(misses or 0),
+        }
@@ -1,31 +1,201 @@
 import os
+import re
+import time
+from threading import Lock
 
 try:
     from fold_to_ascii.fold_to_ascii import mapping
 except:
     from ..fold_to_ascii.fold_to_ascii import mapping
 
+from search import logger
+
+BLACKLIST_FILE = "search_blacklist.txt"
+# Minimum delay in seconds between two checks of the modification time of the blacklist file
+RELOAD_INTERVAL = 2
+
+_separators = re.compile(r"[\W_]+")
+# Stripped from the tokens of queries and terms that keep their punctuation
+_QUOTES = "\"'/\\"
+
+# Forms of a query that the compiled automatons are run on
+WORDS = "words"
+TOKENS = "tokens"
+NORMALIZED = "normalized"
+FOLDED = "folded"
+
+
+class Matcher:
+    """
+    Aho-Corasick automaton, tells if a sequence contains any of the patterns. The symbols
+    can be characters (patterns are strings) or words (patterns are tuples of words)
+    """
+
+    def __init__(self, patterns):
+        # State 0 is the root, goto[state] maps a character to the next state
+        self.goto = [dict()]
+        fail = [0]
+        self.match = [False]
+
+        for pattern in patterns:
+            state = 0
+            for c in pattern:
+                next_state = self.goto[state].get(c)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][c] = next_state
+                    self.goto.append(dict())
+                    fail.append(0)
+                    self.match.append(False)
+                state = next_state
+            self.match[state] = True
+
+        # Breadth-first: the failure state of a state is always computed before its children
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for c, child in self.goto[state].items():
+                queue.append(child)
+                f = fail[state]
+                while f and c not in self.goto[f]:
+                    f = fail[f]
+                fail[child] = self.goto[f].get(c, 0)
+                # A pattern that is a suffix of the current match also matches
+                self.match[child] = self.match[child] or self.match[fail[child]]
+
+        # Follow the failure links once at build time so that search() does one lookup per character
+        for state in queue:
+            f = fail[state]
+            for c, child in self.goto[f].items():
+                if c not in self.goto[state]:
+                    self.goto[state][c] = child
+
+    def search(self, symbols) -> bool:
+        goto = self.goto
+        match = self.match
+        root = goto[0]
+        state = 0
+
+        for c in symbols:
+            state = goto[state].get(c)
+            if state is None:
+                state = root.get(c, 0)
+            if match[state]:
+                return True
+        return False
+
 
 class SearchFilter:
+    """
+    Blocks the queries that contain a term of search_blacklist.txt. Queries and terms are folded
+    to lowercase ascii and punctuation is treated as a space. A term (or phrase of several words)
+    matches whole words, a term written *like this* matches anywhere, even inside a word.
+    Terms that contain punctuation (c++, .net) keep it and are matched on the whitespace
+    separated tokens of the query instead, or anywhere in it when written *like this*.
+    The file is reloaded when it changes.
+    """
 
-    def __init__(self):
+    def __init__(self, path=BLACKLIST_FILE):
 
-        self.blacklisted_terms = set()
+        self.path = path
         self.table = str.maketrans(dict(mapping.translate_table))
 
-        if os.path.exists("search_blacklist.txt"):
-            with open("search_blacklist.txt") as f:
-                self.blacklisted_terms.update(line.strip() for line in f.readlines() if line[0] != "#" and line.strip())
+        self._lock = Lock()
+        self._mtime = None
+        self._checked = 0
+        self.matchers = None
+        self.blacklisted_terms = set()
+        self._reload()
 
-    def should_block(self, query) -> bool:
+    def fold(self, text: str) -> str:
+        if not text.isascii():
+            text = text.translate(self.table)
+        return text.lower()
 
-        query = query.translate(self.table)
-        query = query.lower()
+    def normalize(self, text: str) -> str:
+        return _separators.sub(" ", self.fold(text))
 
-        for raw_token in query.split():
+    @staticmethod
+    def tokenize(folded: str) -> list:
+        return [t for t in (token.strip(_QUOTES) for token in folded.split()) if t]
 
-            token = raw_token.strip("\"'/\\").strip()
-            if token in self.blacklisted_terms:
-                return True
+    def compile(self, terms) -> list:
+        """
+        Returns the (kind, automaton) pairs to run on a query, kind is the form of the query it matches:
+        WORDS and TOKENS for the words and phrases, NORMALIZED and FOLDED for the substrings
+        """
+        patterns = {WORDS: [], TOKENS: [], NORMALIZED: [], FOLDED: []}
+
+        for term in terms:
+            substring = len(term) > 2 and term[0] == "*" and term[-1] == "*"
+            if substring:
+                term = term[1:-1]
+
+            tokens = self.tokenize(self.fold(term))
+            words = self.normalize(term).split()
+            # Normalizing c++ to c would block every query that contains the word c
+            keep_punctuation = tokens != words
+
+            if substring:
+                pattern = " ".join(tokens) if keep_punctuation else " ".join(words)
+                if pattern:
+                    patterns[FOLDED if keep_punctuation else NORMALIZED].append(pattern)
+            elif keep_punctuation:
+                if tokens:
+                    patterns[TOKENS].append(tuple(tokens))
+            elif words:
+                patterns[WORDS].append(tuple(words))
+
+        return [(kind, Matcher(p)) for kind, p in patterns.items() if p]
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+
+        if mtime == self._mtime and self.matchers is not None:
+            return
 
+        terms = set()
+        if mtime is not None:
+            with open(self.path) as f:
+                terms.update(line.strip() for line in f.readlines() if line[0] != "#" and line.strip())
+
+        self.matchers = self.compile(terms)
+        self.blacklisted_terms = terms
+        self._mtime = mtime
+        if mtime is not None:
+            logger.info("Loaded %d blacklisted search terms" % len(terms))
+
+    def _check_reload(self):
+        now = time.monotonic()
+        if now - self._checked < RELOAD_INTERVAL:
+            return
+        # Other threads keep using the current matchers while they are rebuilt
+        if self._lock.acquire(blocking=False):
+            try:
+                self._checked = now
+                self._reload()
+            except Exception as e:
+                logger.error("Could not reload search blacklist: %s" % e)
+            finally:
+                self._lock.release()
+
+    def should_block(self, query) -> bool:
+
+        self._check_reload()
+        folded = self.fold(query)
+        normalized = None
+
+        for kind, matcher in self.matchers:
+            if kind == WORDS or kind == NORMALIZED:
+                if normalized is None:
+                    normalized = _separators.sub(" ", folded)
+                text = normalized.split() if kind == WORDS else normalized
+            elif kind == TOKENS:
+                text = self.tokenize(folded)
+            else:
+                text = " ".join(self.tokenize(folded))
+            if matcher.search(text):
+                return True
         return False
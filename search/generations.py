@@ -0,0 +1,116 @@
+import time
+
+import ujson
+
+
+class GenerationStore:
+    """
+    Keeps track of the generation of documents that is live for each website.
+
+    Every crawl indexed in "generation" mode gets a new, globally unique generation number. It stays
+    hidden from readers until the whole crawl is indexed, then it atomically replaces the previous
+    generation, which is hidden in turn until it is garbage-collected.
+    Documents indexed before generations were used have no generation field ("legacy" documents).
+    """
+
+    SEQUENCE = "oddb:generation:seq"
+    LIVE = "oddb:generation:live"
+    HIDDEN = "oddb:generation:hidden"
+    HIDDEN_LEGACY = "oddb:generation:hidden_legacy"
+    GC = "oddb:generation:gc"
+
+    LEGACY = "legacy"
+    # An unpublished generation older than this was abandoned by its indexer and is collected
+    PENDING_TIMEOUT = 24 * 3600
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def new_generation(self, website_id: int) -> int:
+        """
+        Allocate a generation, it is hidden until publish() is called. It is also registered for
+        garbage collection as pending, so that it is collected if the indexer dies before
+        publish() or discard().
+        """
+        generation = self.redis.incr(GenerationStore.SEQUENCE)
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.sadd(GenerationStore.HIDDEN, generation)
+        pipe.hset(GenerationStore.GC, GenerationStore._gc_key(website_id, generation),
+                  ujson.dumps({"pending": time.time()}))
+        pipe.execute()
+        return generation
+
+    def get_live_generation(self, website_id: int):
+        generation = self.redis.hget(GenerationStore.LIVE, website_id)
+        return int(generation) if generation else None
+
+    def publish(self, website_id: int, generation: int):
+        """Make a generation live and retire the previous one (or the legacy documents) of the website"""
+        old_generation = self.get_live_generation(website_id)
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(GenerationStore.LIVE, website_id, generation)
+        pipe.srem(GenerationStore.HIDDEN, generation)
+        pipe.hdel(GenerationStore.GC, GenerationStore._gc_key(website_id, generation))
+        if old_generation:
+            pipe.sadd(GenerationStore.HIDDEN, old_generation)
+            pipe.hset(GenerationStore.GC, GenerationStore._gc_key(website_id, old_generation), ujson.dumps({}))
+        else:
+            pipe.sadd(GenerationStore.HIDDEN_LEGACY, website_id)
+            pipe.hset(GenerationStore.GC, GenerationStore._gc_key(website_id, GenerationStore.LEGACY), ujson.dumps({}))
+        pipe.execute()
+
+    def discard(self, website_id: int, generation: int):
+        """Give up on an unpublished generation, its documents stay hidden until they are collected"""
+        self.redis.hset(GenerationStore.GC, GenerationStore._gc_key(website_id, generation), ujson.dumps({}))
+
+    def get_gc_entries(self) -> list:
+        """List of (website_id, generation or LEGACY, state) waiting to be garbage-collected"""
+        entries = []
+        for key, state in self.redis.hgetall(GenerationStore.GC).items():
+            website_id, generation = key.decode().split(":")
+            entries.append((int(website_id),
+                            generation if generation == GenerationStore.LEGACY else int(generation),
+                            ujson.loads(state)))
+        return entries
+
+    def set_gc_state(self, website_id: int, generation, state: dict):
+        self.redis.hset(GenerationStore.GC, GenerationStore._gc_key(website_id, generation), ujson.dumps(state))
+
+    def collected(self, website_id: int, generation):
+        """The documents of a retired generation were deleted, stop hiding it"""
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hdel(GenerationStore.GC, GenerationStore._gc_key(website_id, generation))
+        if generation == GenerationStore.LEGACY:
+            pipe.srem(GenerationStore.HIDDEN_LEGACY, website_id)
+        else:
+            pipe.srem(GenerationStore.HIDDEN, generation)
+        pipe.execute()
+
+    def get_hidden_filters(self) -> list:
+        """ES query clauses matching the documents readers must not see"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.smembers(GenerationStore.HIDDEN)
+        pipe.smembers(GenerationStore.HIDDEN_LEGACY)
+        hidden, hidden_legacy = pipe.execute()
+
+        filters = []
+        if hidden:
+            filters.append({"terms": {"generation": [int(g) for g in hidden]}})
+        for website_id in hidden_legacy:
+            filters.append(GenerationStore.legacy_query(int(website_id)))
+        return filters
+
+    @staticmethod
+    def legacy_query(website_id: int) -> dict:
+        return {
+            "bool": {
+                "filter": [{"term": {"website_id": website_id}}],
+                "must_not": [{"exists": {"field": "generation"}}]
+            }
+        }
+
+    @staticmethod
+    def _gc_key(website_id: int, generation) -> str:
+        return "%d:%s" % (website_id, generation)
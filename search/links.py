@@ -0,0 +1,34 @@
+import re
+from urllib.parse import quote, urljoin
+
+# Characters that never need to be percent-encoded in a path, most file names only contain these
+_unsafe_path = re.compile(r"[^A-Za-z0-9_.\-~/]").search
+_unsafe_name = re.compile(r"[^A-Za-z0-9_.\-~]").search
+
+
+def website_root(url: str) -> str:
+    return urljoin(url, "/")
+
+
+def quote_path(path: str) -> str:
+    return quote(path, safe="/") if _unsafe_path(path) else path
+
+
+def quote_name(name: str) -> str:
+    return quote(name, safe="") if _unsafe_name(name) else name
+
+
+def build_link(root: str, src: dict) -> str:
+    """Absolute, percent-encoded url of a document, root is the website_root() of its website"""
+    path = src["path"]
+    ext = src["ext"]
+    return "".join((
+        root,
+        quote_path(path) + "/" if path else "",
+        quote_name(src["name"]),
+        "." + quote_name(ext) if ext else ""
+    ))
+
+
+def build_links(root: str, sources: list) -> list:
+    return [build_link(root, src) for src in sources]
@@ -1,14 +1,53 @@
+import base64
+import hashlib
+import heapq
 import os
 import time
-from urllib.parse import urljoin
+from itertools import chain
+from tempfile import TemporaryFile
 
 import elasticsearch
 import ujson
-from apscheduler.schedulers.background import BackgroundScheduler
 from elasticsearch import helpers
 
 from search import logger
+from search.bulk import BulkIndexer, BulkThrottle, BULK_MAX_BYTES, BULK_IN_FLIGHT
 from search.filter import SearchFilter
+from search.generations import GenerationStore
+from search.links import build_links, website_root
+
+# Number of file ids sorted in memory by import_json_incremental, larger crawls are sorted on disk
+SORT_CHUNK_SIZE = 500000
+# Number of crawled documents looked up in the index at once by import_json_incremental
+LOOKUP_BATCH_SIZE = 1000
+
+
+def sort_ids(ids, chunk_size=SORT_CHUNK_SIZE):
+    """Sort file ids, in chunks of chunk_size ids that are merged from temporary files"""
+
+    chunks = []
+    chunk = []
+    try:
+        for file_id in ids:
+            chunk.append(file_id + "\n")
+            if len(chunk) >= chunk_size:
+                chunks.append(_write_chunk(chunk))
+                chunk = []
+        chunk.sort()
+
+        for line in heapq.merge(chunk, *chunks):
+            yield line[:-1]
+    finally:
+        for f in chunks:
+            f.close()
+
+
+def _write_chunk(chunk: list):
+    chunk.sort()
+    f = TemporaryFile("w+")
+    f.writelines(chunk)
+    f.seek(0)
+    return f
 
 
 class InvalidQueryException(Exception):
@@ -28,10 +67,16 @@ class ElasticSearchEngine:
         "date_desc": [{"mtime": {"order": "desc"}}],
         "none": []
     }
+    # Makes the sort order total, which search_after pagination requires. file_id is a keyword written
+    # at index time, sorting on it uses doc values instead of loading _id in the fielddata cache.
+    # Documents indexed before file_id existed have none until backfill_website_url.py sets it: ties
+    # between them are not broken and cursor pagination can skip or repeat them until then.
+    SORT_TIEBREAKER = [{"file_id": {"order": "asc"}}]
 
-    def __init__(self, url, index_name):
+    def __init__(self, url, index_name, generations=None):
         super().__init__()
         self.index_name = index_name
+        self.generations = generations
         logger.info("Connecting to ES @ %s" % url)
         self.es = elasticsearch.Elasticsearch(hosts=[url])
         self.filter = SearchFilter()
@@ -39,11 +84,6 @@ class ElasticSearchEngine:
         if not self.es.indices.exists(self.index_name):
             self.init()
 
-    def start_stats_scheduler(self):
-        scheduler = BackgroundScheduler()
-        scheduler.add_job(self._generate_global_stats, "interval", seconds=60 * 120)
-        scheduler.start()
-
     def init(self):
         logger.info("Elasticsearch first time setup")
         if self.es.indices.exists(self.index_name):
@@ -82,112 +122,363 @@ class ElasticSearchEngine:
                 "size": {"type": "long"},
                 "website_id": {"type": "integer"},
                 "ext": {"type": "keyword"},
+                "generation": {"type": "long"},
+                "website_url": {"type": "keyword"},
+                "file_id": {"type": "keyword"},
             },
             "_routing": {"required": True}
         }, doc_type="file", index=self.index_name, include_type_name=True)
 
         self.es.indices.open(index=self.index_name)
 
-    def delete_docs(self, website_id):
+    def update_mapping(self):
+        """Add the fields introduced after the index was created, run by migrate.py"""
+        self.es.indices.put_mapping(body={
+            "properties": {
+                "website_url": {"type": "keyword"},
+                "file_id": {"type": "keyword"},
+            }
+        }, doc_type="file", index=self.index_name, include_type_name=True)
 
-        while True:
-            try:
-                logger.debug("Deleting docs of " + str(website_id))
+    def start_delete_docs(self, website_id: int) -> str:
+        """Start deleting all documents of a website as a background ES task, returns the task id"""
 
-                to_delete = helpers.scan(query={
-                    "query": {
-                        "term": {
-                            "website_id": website_id
-                        }
-                    }
-                }, scroll="1m", client=self.es, index=self.index_name, request_timeout=120, routing=website_id)
-
-                buf = []
-                counter = 0
-                for doc in to_delete:
-                    buf.append(doc)
-                    counter += 1
-
-                    if counter >= 10000:
-                        self._delete(buf, website_id)
-                        buf.clear()
-                        counter = 0
-                if counter > 0:
-                    self._delete(buf, website_id)
-                break
+        logger.debug("Deleting docs of " + str(website_id))
+        result = self.es.delete_by_query(body={
+            "query": {
+                "term": {
+                    "website_id": website_id
+                }
+            }
+        }, index=self.index_name, routing=website_id, slices="auto", conflicts="proceed",
+            wait_for_completion=False, request_timeout=30)
 
-            except Exception as e:
-                logger.error("During delete: " + str(e))
-                time.sleep(10)
+        return result["task"]
 
-        logger.debug("Done deleting for " + str(website_id))
+    def start_delete_generation(self, website_id: int, generation) -> str:
+        """Start deleting the documents of a retired generation as a background ES task, returns the task id"""
 
-    def _delete(self, docs, website_id):
-        bulk_string = self.create_bulk_delete_string(docs)
-        result = self.es.bulk(body=bulk_string, index=self.index_name, doc_type="file", request_timeout=30,
-                              routing=website_id)
+        if generation == GenerationStore.LEGACY:
+            query = GenerationStore.legacy_query(website_id)
+        else:
+            query = {
+                "bool": {
+                    "filter": [
+                        {"term": {"website_id": website_id}},
+                        {"term": {"generation": generation}}
+                    ]
+                }
+            }
 
-        if result["errors"]:
-            logger.error("Error in ES bulk delete: \n" + result["errors"])
-            raise IndexingError
+        result = self.es.delete_by_query(body={"query": query}, index=self.index_name, routing=website_id,
+                                         slices="auto", conflicts="proceed", wait_for_completion=False,
+                                         request_timeout=30)
+        return result["task"]
+
+    def start_backfill_website_url(self, website_id: int, website_url: str, tracked_only=False) -> str:
+        """
+        Set website_url (and file_id) on the documents of a website indexed without them,
+        returns the ES task id.
+        tracked_only: only update the documents that have a file_id, the other ones are being deleted
+        by start_delete_untracked() and an update would make the deletion skip them
+        """
+
+        if tracked_only:
+            query = {
+                "bool": {
+                    "filter": [
+                        {"term": {"website_id": website_id}},
+                        {"exists": {"field": "file_id"}}
+                    ],
+                    "must_not": [{"exists": {"field": "website_url"}}]
+                }
+            }
+        else:
+            query = {
+                "bool": {
+                    "filter": [{"term": {"website_id": website_id}}],
+                    "should": [
+                        {"bool": {"must_not": [{"exists": {"field": "website_url"}}]}},
+                        {"bool": {"must_not": [{"exists": {"field": "file_id"}}]}}
+                    ],
+                    "minimum_should_match": 1
+                }
+            }
 
-    def import_json(self, in_lines, website_id: int):
+        result = self.es.update_by_query(body={
+            "query": query,
+            "script": {
+                "source": "ctx._source.website_url = params.website_url; "
+                          "if (ctx._source.file_id == null) { ctx._source.file_id = ctx._id }",
+                "lang": "painless",
+                "params": {"website_url": website_url}
+            }
+        }, index=self.index_name, routing=website_id, conflicts="proceed", wait_for_completion=False,
+            request_timeout=30)
+        return result["task"]
+
+    def count_docs_without_website_url(self) -> int:
+        return self.es.count(body={
+            "query": {"bool": {"must_not": [{"exists": {"field": "website_url"}}]}}
+        }, index=self.index_name, request_timeout=30)["count"]
+
+    def count_docs_without_file_id(self) -> int:
+        return self.es.count(body={
+            "query": {"bool": {"must_not": [{"exists": {"field": "file_id"}}]}}
+        }, index=self.index_name, request_timeout=30)["count"]
+
+    def _get_hidden_filters(self) -> list:
+        return self.generations.get_hidden_filters() if self.generations else []
+
+    def get_task_progress(self, task_id: str) -> dict:
+
+        result = self.es.tasks.get(task_id=task_id, request_timeout=30)
+        status = result["task"]["status"]
+
+        progress = dict()
+        progress["completed"] = result["completed"]
+        progress["total"] = status.get("total", 0)
+        progress["deleted"] = status.get("deleted", 0)
+        progress["updated"] = status.get("updated", 0)
+        progress["running_time"] = result["task"]["running_time_in_nanos"] / 1000000000
+        if "error" in result:
+            progress["error"] = str(result["error"].get("reason", result["error"]))
+        elif result["completed"] and result["response"]["failures"]:
+            progress["error"] = str(result["response"]["failures"][0])
+        else:
+            progress["error"] = None
 
-        import_every = 10000
-        cooldown_time = 0
+        return progress
 
-        docs = []
+    def delete_docs(self, website_id: int, max_retries: int = 5, poll_interval: float = 2):
+        """Delete all documents of a website and wait for the deletion to complete"""
 
-        for line in in_lines:
+        task_id = None
+        for attempt in range(max_retries):
             try:
-                doc = ujson.loads(line)
-                name, ext = os.path.splitext(doc["name"])
-                doc["ext"] = ext[1:].lower() if ext and len(ext) > 1 else ""
-                doc["name"] = name
-                doc["website_id"] = website_id
-                docs.append(doc)
-            except Exception as e:
-                logger.error("Error in import_json: " + str(e) + " for line : + \n" + line)
+                # A task that is still running is polled again instead of starting another one
+                if not task_id:
+                    task_id = self.start_delete_docs(website_id)
 
-            if len(docs) >= import_every:
-                self._index(docs)
-                docs.clear()
-                time.sleep(cooldown_time)
+                progress = self.get_task_progress(task_id)
+                while not progress["completed"]:
+                    time.sleep(poll_interval)
+                    progress = self.get_task_progress(task_id)
 
-        if docs:
-            self._index(docs)
+                if progress["error"]:
+                    task_id = None
+                    raise IndexingError(progress["error"])
+
+                logger.debug("Done deleting %d docs for %d" % (progress["deleted"], website_id))
+                return progress
 
-    def _index(self, docs):
-        while True:
-            try:
-                logger.debug("Indexing " + str(len(docs)) + " docs")
-                bulk_string = ElasticSearchEngine.create_bulk_index_string(docs)
-                self.es.bulk(body=bulk_string, index=self.index_name, doc_type="file", request_timeout=30,
-                             routing=docs[0]["website_id"])
-                break
             except Exception as e:
-                logger.error("Error in _index: " + str(e) + ", retrying")
-                time.sleep(10)
+                logger.error("During delete (attempt %d/%d): %s" % (attempt + 1, max_retries, e))
+                time.sleep(min(60, 5 * 2 ** attempt))
 
-    @staticmethod
-    def create_bulk_index_string(docs: list):
+        raise IndexingError("Could not delete docs of website " + str(website_id))
 
-        action_string = '{"index":{}}\n'
-        return "\n".join("".join([action_string, ujson.dumps(doc)]) for doc in docs)
+    def import_json(self, in_lines, website_id: int, max_bytes=BULK_MAX_BYTES, max_in_flight=BULK_IN_FLIGHT,
+                    generation: int = None, stats=None, throttle: BulkThrottle = None, website_url: str = None) -> dict:
+        """
+        stats: optional accumulator, its add() method is called with every document of the crawl
+        website_url: root url of the website, stored in each document so that results need no join
+        """
 
-    @staticmethod
-    def create_bulk_delete_string(docs: list):
+        indexer = BulkIndexer(self.es, self.index_name, routing=website_id,
+                              max_bytes=max_bytes, max_in_flight=max_in_flight, throttle=throttle)
+
+        for line in in_lines:
+            doc = ElasticSearchEngine.parse_doc(line, website_id, website_url)
+            if doc:
+                if stats:
+                    stats.add(doc)
+                if generation:
+                    # Generations of the same file coexist until the old one is collected
+                    doc["generation"] = generation
+                    indexer.add(doc)
+                else:
+                    indexer.add(doc, doc["file_id"])
+
+        result = indexer.close()
+        logger.debug("Imported docs of %d: %s" % (website_id, result))
+        return result
+
+    def import_json_incremental(self, in_lines, website_id: int, max_bytes=BULK_MAX_BYTES,
+                                max_in_flight=BULK_IN_FLIGHT, stats=None, throttle: BulkThrottle = None,
+                                website_url: str = None) -> dict:
+        """
+        Only index the documents that are new or whose size/mtime changed since the last crawl,
+        then delete the documents that are no longer in the crawl.
+        Documents are looked up and indexed in batches while the crawl is received. Their ids are
+        sorted on disk and merged with the ids of the indexed documents, read in the same order, to
+        find the removed ones once the crawl is complete, so that neither side is loaded in memory.
+        """
+
+        indexer = BulkIndexer(self.es, self.index_name, routing=website_id,
+                              max_bytes=max_bytes, max_in_flight=max_in_flight, throttle=throttle)
+        counts = {"added": 0, "changed": 0, "unchanged": 0}
+
+        def index_batch(batch: dict):
+            versions = self.lookup_doc_versions(website_id, list(batch.keys()))
+            for doc_id, doc in batch.items():
+                if stats:
+                    stats.add(doc)
+                version = versions.get(doc_id)
+                if version is None:
+                    counts["added"] += 1
+                    indexer.add(doc, doc_id)
+                elif version != (doc.get("size"), doc.get("mtime")):
+                    counts["changed"] += 1
+                    indexer.add(doc, doc_id)
+                else:
+                    counts["unchanged"] += 1
+
+        def crawl_ids():
+            # Duplicate entries of the crawl are only skipped within a batch
+            batch = dict()
+            for line in in_lines:
+                doc = ElasticSearchEngine.parse_doc(line, website_id, website_url)
+                if not doc:
+                    continue
+                batch[doc["file_id"]] = doc
+                yield doc["file_id"]
+
+                if len(batch) >= LOOKUP_BATCH_SIZE:
+                    index_batch(batch)
+                    batch = dict()
+            if batch:
+                index_batch(batch)
+
+        crawl = sort_ids(crawl_ids())
+        # Reads (and indexes) the whole crawl before it returns the first id. The documents indexed by
+        # this import are not all searchable yet, they are in the crawl anyway.
+        first_id = next(crawl, None)
+        versions = self.stream_doc_versions(website_id)
+        current = next(versions, None)
+        removed = 0
+        last_id = None
+
+        for doc_id in chain([first_id], crawl) if first_id else []:
+            if doc_id == last_id:
+                continue
+            last_id = doc_id
+
+            while current and current[0] < doc_id:
+                removed += 1
+                indexer.delete(current[0])
+                current = next(versions, None)
+            if current and current[0] == doc_id:
+                current = next(versions, None)
+
+        while current:
+            removed += 1
+            indexer.delete(current[0])
+            current = next(versions, None)
+
+        result = indexer.close()
+        result.update(removed=removed, untracked=self.start_delete_untracked(website_id), **counts)
+        logger.debug("Incrementally imported docs of %d: %s" % (website_id, result))
+        return result
+
+    def lookup_doc_versions(self, website_id: int, ids: list) -> dict:
+        """id -> (size, mtime) of the indexed documents among ids"""
+
+        docs = self.es.mget(body={"ids": ids}, index=self.index_name, routing=website_id,
+                            _source_includes=["size", "mtime"], request_timeout=120)["docs"]
+        return {doc["_id"]: (doc["_source"].get("size"), doc["_source"].get("mtime"))
+                for doc in docs if doc.get("found")}
+
+    def stream_doc_versions(self, website_id: int, size=5000):
+        """(id, (size, mtime)) of the documents of a website tracked by incremental indexing, sorted by id"""
+
+        body = {
+            "_source": {
+                "includes": ["size", "mtime"]
+            },
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"term": {"website_id": website_id}},
+                        {"exists": {"field": "file_id"}}
+                    ],
+                    "must_not": [{"exists": {"field": "generation"}}] + self._get_hidden_filters()
+                }
+            },
+            "sort": [{"file_id": {"order": "asc"}}],
+            "size": size
+        }
 
-        return "\n".join("".join(["{\"delete\":{\"_id\":\"", doc["_id"], "\"}}"]) for doc in docs)
+        while True:
+            hits = self.es.search(body=body, index=self.index_name, routing=website_id,
+                                  request_timeout=120)["hits"]["hits"]
+            for hit in hits:
+                yield hit["_id"], (hit["_source"].get("size"), hit["_source"].get("mtime"))
+            if len(hits) < size:
+                return
+            body["search_after"] = hits[-1]["sort"]
+
+    def start_delete_untracked(self, website_id: int) -> int:
+        """
+        Start deleting the documents of a website that incremental indexing does not track: the ones
+        indexed without file_id (random ids) or by generation. Returns their count.
+        """
+
+        query = {
+            "bool": {
+                "filter": [{"term": {"website_id": website_id}}],
+                "should": [
+                    {"bool": {"must_not": [{"exists": {"field": "file_id"}}]}},
+                    {"exists": {"field": "generation"}}
+                ],
+                "minimum_should_match": 1
+            }
+        }
+        count = self.es.count(body={"query": query}, index=self.index_name, routing=website_id,
+                              request_timeout=30)["count"]
+        if count:
+            # The documents re-indexed with a file_id by this import have a newer version and are skipped
+            self.es.delete_by_query(body={"query": query}, index=self.index_name, routing=website_id,
+                                    conflicts="proceed", wait_for_completion=False, request_timeout=30)
+        return count
 
-    def search(self, query, page, per_page, sort_order, extensions, size_min, size_max, match_all, fields, date_min,
-               date_max) -> {}:
+    @staticmethod
+    def doc_id(website_id: int, doc: dict) -> str:
+        """Stable document id derived from the location of the file"""
+        key = "\0".join((str(website_id), doc.get("path", ""), doc["name"], doc["ext"]))
+        return base64.urlsafe_b64encode(hashlib.sha1(key.encode()).digest()[:15]).decode()
 
+    @staticmethod
+    def parse_doc(line, website_id: int, website_url: str = None):
+        try:
+            doc = ujson.loads(line)
+            name, ext = os.path.splitext(doc["name"])
+            doc["ext"] = ext[1:].lower() if ext and len(ext) > 1 else ""
+            doc["name"] = name
+            doc["website_id"] = website_id
+            if website_url:
+                doc["website_url"] = website_url
+            doc["file_id"] = ElasticSearchEngine.doc_id(website_id, doc)
+            return doc
+        except Exception as e:
+            logger.error("Error in import_json: " + str(e) + " for line : + \n" + line)
+            return None
+
+    def check_query(self, query):
         if self.filter.should_block(query):
             logger.info("Search was blocked")
             raise InvalidQueryException("One or more terms in your query is blocked by the search filter. "
                                         "This incident has been reported.")
 
+    def search(self, query, page, per_page, sort_order, extensions, size_min, size_max, match_all, fields, date_min,
+               date_max, search_after=None) -> {}:
+        """
+        The query must have been checked with check_query() first.
+        search_after=None uses from/size pagination (limited to the first 10000 results),
+        otherwise the results are sorted with a tiebreaker and search_after is the "sort" value of the
+        last hit of the previous page ([] for the first page).
+        """
+
         filters = []
         if extensions:
             filters.append({"terms": {"ext": extensions}})
@@ -216,7 +507,7 @@ class ElasticSearchEngine:
 
         sort_by = ElasticSearchEngine.SORT_ORDERS.get(sort_order, [])
 
-        page = self.es.search(body={
+        body = {
             "query": {
                 "bool": {
                     "must": {
@@ -226,7 +517,8 @@ class ElasticSearchEngine:
                             "operator": "or" if match_all else "and"
                         }
                     },
-                    "filter": filters
+                    "filter": filters,
+                    "must_not": self._get_hidden_filters()
                 }
             },
             "sort": sort_by,
@@ -237,19 +529,47 @@ class ElasticSearchEngine:
                     "path": {"pre_tags": ["<mark>"], "post_tags": ["</mark>"]}
                 }
             },
-            "size": per_page, "from": min(page * per_page, 10000 - per_page)},
-            index=self.index_name, request_timeout=20)
+            "size": per_page
+        }
 
-        return page
+        if search_after is None:
+            body["from"] = min(page * per_page, 10000 - per_page)
+        else:
+            body["sort"] = sort_by + ElasticSearchEngine.SORT_TIEBREAKER
+            if search_after:
+                body["search_after"] = search_after
+
+        return self.es.search(body=body, index=self.index_name, request_timeout=20)
+
+    @staticmethod
+    def make_cursor(page: dict, per_page: int, query_key: str):
+        """Opaque token pointing after the last hit of a page, None if this was the last page"""
+        hits = page["hits"]["hits"]
+        if len(hits) < per_page:
+            return None
+        return base64.urlsafe_b64encode(ujson.dumps([query_key, hits[-1]["sort"]]).encode()).decode()
+
+    @staticmethod
+    def parse_cursor(cursor: str, query_key: str) -> list:
+        if not cursor:
+            return []
+        try:
+            cursor_key, search_after = ujson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except Exception:
+            raise InvalidQueryException("Invalid cursor")
+        if cursor_key != query_key:
+            raise InvalidQueryException("This cursor was created for a different query")
+        return search_after
 
     def get_stats(self, website_id: int, subdir: str = None):
 
         result = self.es.search(body={
             "query": {
-                "constant_score": {
-                    "filter": {
-                        "term": {"website_id": website_id}
-                    }
+                "bool": {
+                    "filter": [
+                        {"term": {"website_id": website_id}}
+                    ],
+                    "must_not": self._get_hidden_filters()
                 }
             },
             "aggs": {
@@ -291,45 +611,48 @@ class ElasticSearchEngine:
                                     "includes": ["path", "name", "ext"]
                                 },
                                 "query": {
-                                    "constant_score": {
-                                        "filter": {
-                                            "term": {"website_id": website_id}
-                                        }
+                                    "bool": {
+                                        "filter": [
+                                            {"term": {"website_id": website_id}}
+                                        ],
+                                        "must_not": self._get_hidden_filters()
                                     }
                                 },
                             },
-                            index=self.index_name, request_timeout=20, routing=website_id)
-        for hit in hits:
-            src = hit["_source"]
-            yield urljoin(base_url, "/") + src["path"] + ("/" if src["path"] != "" else "") + src["name"] + \
-                  ("." if src["ext"] != "" else "") + src["ext"]
-
-    @staticmethod
-    def get_global_stats():
-
-        if os.path.exists("_stats.json"):
-            with open("_stats.json", "r") as f:
-                return ujson.load(f)
-        else:
-            return None
+                            size=5000, index=self.index_name, request_timeout=20, routing=website_id)
 
-    def _generate_global_stats(self):
+        root = website_root(base_url)
+        batch = []
+        for hit in hits:
+            batch.append(hit["_source"])
+            if len(batch) >= 5000:
+                yield from build_links(root, batch)
+                batch = []
+        yield from build_links(root, batch)
+
+    def get_website_contribution(self, website_id: int) -> dict:
+        """
+        Statistics of the documents of a website that can be merged with the ones of other websites
+        to compute the global stats (see stats.py)
+        """
 
-        size_per_ext = self.es.search(body={
+        result = self.es.search(body={
             "query": {
                 "bool": {
                     "filter": [
+                        {"term": {"website_id": website_id}},
                         {"range": {
                             "size": {"gte": 0, "lte": (1000000000000 - 1)}  # 0-1TB
                         }}
-                    ]
+                    ],
+                    "must_not": self._get_hidden_filters()
                 }
             },
             "aggs": {
                 "ext_group": {
                     "terms": {
                         "field": "ext",
-                        "size": 40
+                        "size": 1000
                     },
                     "aggs": {
                         "size": {
@@ -338,98 +661,67 @@ class ElasticSearchEngine:
                             }
                         }
                     }
-                }
-            },
-            "size": 0
-
-        }, index=self.index_name, request_timeout=240)
-
-        total_stats = self.es.search(body={
-            "query": {
-                "bool": {
-                    "filter": [
-                        {"range": {
-                            "size": {"gte": 0, "lte": (1000000000000 - 1)}  # 0-1TB
-                        }}
-                    ]
-                }
-            },
-            "aggs": {
+                },
                 "file_stats": {
                     "extended_stats": {
-                        "field": "size",
-                        "sigma": 1
+                        "field": "size"
                     }
-                }
-            },
-            "size": 0
-
-        }, index=self.index_name, request_timeout=241)
-
-        size_and_date_histogram = self.es.search(body={
-            "query": {
-                "bool": {
-                    "filter": [
-                        {"range": {
-                            "size": {"gte": 0, "lte": (1000000000000 - 1)}  # 0-1TB
-                        }},
-                        {"range": {
-                            "mtime": {
-                                "gt": 0  # 1970-01-01
-                            }
-                        }}
-                    ]
-                }
-            },
-            "aggs": {
+                },
                 "sizes": {
                     "histogram": {
                         "field": "size",
                         "interval": 100000000,  # 100Mb
-                        "min_doc_count": 500
+                        "min_doc_count": 1
                     }
                 },
-                "dates": {
-                    "date_histogram": {
-                        "field": "mtime",
-                        "interval": "1y",
-                        "min_doc_count": 500,
-                        "format": "yyyy"
-                    }
-                }
-            },
-            "size": 0
-        }, index=self.index_name, request_timeout=242)
-
-        website_scatter = self.es.search(body={
-            "query": {
-                "bool": {
-                    "filter": [
-                        {"range": {
-                            "size": {"gte": 0, "lte": (1000000000000 - 1)}  # 0-1TB
-                        }}
-                    ]
-                }
-            },
-            "aggs": {
-                "websites": {
-                    "terms": {
-                        "field": "website_id",
-                        "size": 600  # TODO: Figure out what size is appropriate
+                "dated": {
+                    "filter": {
+                        "range": {
+                            "mtime": {
+                                "gt": 0  # 1970-01-01
+                            }
+                        }
                     },
                     "aggs": {
-                        "size": {
-                            "sum": {
-                                "field": "size"
+                        "dates": {
+                            "date_histogram": {
+                                "field": "mtime",
+                                "interval": "1y",
+                                "min_doc_count": 1,
+                                "format": "yyyy"
                             }
                         }
                     }
                 }
             },
             "size": 0
-        }, index=self.index_name, request_timeout=243)
+        }, index=self.index_name, request_timeout=120, routing=website_id)
+
+        file_stats = result["aggregations"]["file_stats"]
 
-        es_stats = self.es.indices.stats(self.index_name, request_timeout=244)
+        contribution = dict()
+        contribution["total_count"] = self.es.count(body={
+            "query": {
+                "bool": {
+                    "filter": [{"term": {"website_id": website_id}}],
+                    "must_not": self._get_hidden_filters()
+                }
+            }
+        }, index=self.index_name, routing=website_id, request_timeout=30)["count"]
+        contribution["count"] = file_stats["count"]
+        contribution["size"] = file_stats["sum"] or 0
+        contribution["size_sq"] = file_stats["sum_of_squares"] or 0
+        contribution["ext"] = {b["key"]: [b["doc_count"], b["size"]["value"]]
+                               for b in result["aggregations"]["ext_group"]["buckets"]}
+        contribution["sizes"] = {str(int(b["key"])): b["doc_count"]
+                                 for b in result["aggregations"]["sizes"]["buckets"]}
+        contribution["dates"] = {b["key_as_string"]: b["doc_count"]
+                                 for b in result["aggregations"]["dated"]["dates"]["buckets"]}
+        return contribution
+
+    def get_index_stats(self) -> dict:
+
+        es_stats = self.es.indices.stats(self.index_name, request_timeout=30)
 
         stats = dict()
         stats["es_index_size"] = es_stats["indices"][self.index_name]["total"]["store"]["size_in_bytes"]
@@ -437,32 +729,41 @@ class ElasticSearchEngine:
         stats["es_search_time"] = es_stats["indices"][self.index_name]["total"]["search"]["query_time_in_millis"]
         stats["es_search_time_avg"] = stats["es_search_time"] / (
             stats["es_search_count"] if stats["es_search_count"] != 0 else 1)
+        return stats
 
-        stats["total_count"] = total_stats["aggregations"]["file_stats"]["count"]
-        stats["total_size"] = total_stats["aggregations"]["file_stats"]["sum"]
-        stats["size_avg"] = total_stats["aggregations"]["file_stats"]["avg"]
-        stats["size_std_deviation"] = total_stats["aggregations"]["file_stats"]["std_deviation"]
-        stats["size_std_deviation_bounds"] = total_stats["aggregations"]["file_stats"]["std_deviation_bounds"]
-        stats["size_variance"] = total_stats["aggregations"]["file_stats"]["variance"]
-        stats["ext_stats"] = [(b["size"]["value"], b["doc_count"], b["key"])
-                              for b in size_per_ext["aggregations"]["ext_group"]["buckets"]]
-        stats["sizes_histogram"] = [(b["key"], b["doc_count"])
-                                    for b in size_and_date_histogram["aggregations"]["sizes"]["buckets"]]
-        stats["dates_histogram"] = [(b["key_as_string"], b["doc_count"])
-                                    for b in size_and_date_histogram["aggregations"]["dates"]["buckets"]]
-        stats["website_scatter"] = [[b["key"], b["doc_count"], b["size"]["value"]]
-                                    for b in website_scatter["aggregations"]["websites"]["buckets"]]
-        stats["base_url"] = "entire database"
-
-        with open("_stats.json", "w") as f:
-            ujson.dump(stats, f)
-
-    def stream_all_docs(self):
-        return helpers.scan(query={
+    def stream_all_docs(self, slice_id: int = None, slices: int = None):
+        query = {
             "query": {
-                "match_all": {}
+                "bool": {
+                    "must_not": self._get_hidden_filters()
+                }
             }
-        }, scroll="30s", client=self.es, index=self.index_name, request_timeout=30)
+        }
+        if slices and slices > 1:
+            query["slice"] = {"id": slice_id, "max": slices}
+
+        return helpers.scan(query=query, scroll="30s", size=5000, client=self.es, index=self.index_name,
+                            request_timeout=30)
+
+    def stream_website_docs(self, website_id: int):
+        return helpers.scan(client=self.es,
+                            query={
+                                "_source": {
+                                    "includes": ["path", "name", "ext", "size", "mtime"]
+                                },
+                                "query": {
+                                    "bool": {
+                                        "filter": [
+                                            {"term": {"website_id": website_id}}
+                                        ],
+                                        "must_not": self._get_hidden_filters()
+                                    }
+                                },
+                            },
+                            scroll="1m", size=5000, index=self.index_name, request_timeout=60, routing=website_id)
+
+    def count_all_docs(self) -> int:
+        return self.es.count(index=self.index_name, request_timeout=30)["count"]
 
     def refresh(self):
         self.es.indices.refresh(self.index_name)
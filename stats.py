@@ -0,0 +1,240 @@
+import logging
+import math
+import os
+import time
+from uuid import uuid4
+
+import ujson
+from apscheduler.schedulers.background import BackgroundScheduler
+
+import config
+
+logger = logging.getLogger("default")
+
+
+MAX_FILE_SIZE = 1000000000000 - 1  # 1TB
+SIZE_HISTOGRAM_INTERVAL = 100000000  # 100Mb
+
+
+class WebsiteContribution:
+    """Accumulates the stats of a website while its documents are imported (see StatsGenerator.merge)"""
+
+    def __init__(self):
+        # Every document, count only includes the ones with a valid size like the global stats
+        self.total_count = 0
+        self.count = 0
+        self.size = 0
+        self.size_sq = 0
+        self.ext = dict()
+        self.sizes = dict()
+        self.dates = dict()
+
+    def add(self, doc: dict):
+        self.total_count += 1
+
+        size = doc.get("size")
+        if size is None or not 0 <= size <= MAX_FILE_SIZE:
+            return
+
+        self.count += 1
+        self.size += size
+        self.size_sq += size * size
+
+        ext = self.ext.get(doc["ext"])
+        if ext:
+            ext[0] += 1
+            ext[1] += size
+        else:
+            self.ext[doc["ext"]] = [1, size]
+
+        bucket = str(size - size % SIZE_HISTOGRAM_INTERVAL)
+        self.sizes[bucket] = self.sizes.get(bucket, 0) + 1
+
+        mtime = doc.get("mtime")
+        if mtime and mtime > 0:
+            try:
+                year = time.strftime("%Y", time.gmtime(mtime))
+            except (OverflowError, OSError, ValueError):
+                return
+            self.dates[year] = self.dates.get(year, 0) + 1
+
+    def to_dict(self) -> dict:
+        return {
+            "total_count": self.total_count,
+            "count": self.count,
+            "size": self.size,
+            "size_sq": self.size_sq,
+            "ext": self.ext,
+            "sizes": self.sizes,
+            "dates": self.dates,
+        }
+
+
+def get_website_stats(db, search, website_id: int) -> dict:
+    """
+    Stats of a website (website page, reddit bot), read from the contribution saved at index time.
+    Websites whose contribution was saved without total_count fall back to an ES aggregation.
+    """
+    contribution = db.get_website_stats(website_id)
+    if contribution is None or "total_count" not in contribution:
+        return search.get_stats(website_id)
+
+    stats = dict()
+    stats["total_size"] = contribution["size"]
+    stats["total_count"] = contribution["total_count"]
+    stats["ext_stats"] = [(v[1], v[0], k)
+                          for k, v in sorted(contribution["ext"].items(), key=lambda e: -e[1][0])[:12]]
+    return stats
+
+
+class StatsGenerator:
+    """
+    Maintains the global stats from per-website contributions stored in the database.
+    A website's contribution is recomputed with a single routed aggregation when it is indexed, so
+    the global stats never need an aggregation over the whole index.
+
+    Only one process (the leader, elected with a Redis lock) merges the contributions. It publishes
+    the result in Redis with a version number, the other processes keep a local copy of the stats
+    and only reload it when the version changes.
+    """
+
+    LEADER = "oddb:stats:leader"
+    BLOB = "oddb:stats:blob"
+    VERSION = "oddb:stats:version"
+
+    # Take the lock if it is free, or extend it if we already hold it
+    ELECT_SCRIPT = """
+    local holder = redis.call("GET", KEYS[1])
+    if holder == false or holder == ARGV[1] then
+        redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+        return 1
+    end
+    return 0
+    """
+
+    def __init__(self, db, search, redis):
+        self.db = db
+        self.search = search
+        self.redis = redis
+
+        self.node_id = str(uuid4())
+        self._elect = redis.register_script(StatsGenerator.ELECT_SCRIPT)
+        self._stats = None
+        self._stats_version = None
+
+    def update_website(self, website_id: int, contribution: WebsiteContribution = None):
+        """Save the contribution accumulated during import, or compute it with an aggregation"""
+        if contribution:
+            self.db.set_website_stats(website_id, contribution.to_dict())
+        else:
+            self.db.set_website_stats(website_id, self.search.get_website_contribution(website_id))
+
+    def is_leader(self) -> bool:
+        return bool(self._elect(keys=[StatsGenerator.LEADER], args=[self.node_id, config.STATS_INTERVAL * 3000]))
+
+    def backfill(self, size: int = 100):
+        """Compute the contribution of websites indexed before per-website stats existed, a few at a time"""
+        if not self.is_leader():
+            return
+
+        for website_id in self.db.get_websites_without_stats(size):
+            try:
+                self.update_website(website_id)
+            except Exception as e:
+                logger.error("Could not compute stats of website %d: %s" % (website_id, e))
+
+    def start_scheduler(self):
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(self.backfill, "interval", seconds=60)
+        scheduler.add_job(self.generate_global_stats, "interval", seconds=config.STATS_INTERVAL)
+        scheduler.start()
+
+    def generate_global_stats(self):
+        if not self.is_leader():
+            return
+
+        start = time.time()
+        stats = StatsGenerator.merge(self.db.iter_website_stats())
+        stats.update(self.search.get_index_stats())
+        blob = ujson.dumps(stats)
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(StatsGenerator.BLOB, blob)
+        pipe.incr(StatsGenerator.VERSION)
+        pipe.execute()
+
+        # Also kept on disk for external consumers, replaced atomically
+        with open("_stats.json.part", "w") as f:
+            f.write(blob)
+        os.replace("_stats.json.part", "_stats.json")
+
+        logger.debug("Generated global stats in %.2fs" % (time.time() - start))
+
+    def get_global_stats(self):
+        """Process-local copy of the latest published stats, None if they were never generated"""
+        version = self.redis.get(StatsGenerator.VERSION)
+
+        if version != self._stats_version:
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.get(StatsGenerator.BLOB)
+            pipe.get(StatsGenerator.VERSION)
+            blob, version = pipe.execute()
+
+            self._stats = ujson.loads(blob) if blob else None
+            self._stats_version = version
+
+        # Callers add their own keys to the stats
+        return dict(self._stats) if self._stats else None
+
+    @staticmethod
+    def merge(contributions) -> dict:
+        """Combine (website_id, contribution) pairs into the format of the global stats"""
+
+        count = 0
+        total_size = 0
+        total_size_sq = 0
+        ext = dict()
+        sizes = dict()
+        dates = dict()
+        websites = []
+
+        for website_id, contribution in contributions:
+            if not contribution["count"]:
+                continue
+
+            count += contribution["count"]
+            total_size += contribution["size"]
+            total_size_sq += contribution["size_sq"]
+            websites.append([website_id, contribution["count"], contribution["size"]])
+
+            for key, (ext_count, ext_size) in contribution["ext"].items():
+                acc = ext.setdefault(key, [0, 0])
+                acc[0] += ext_count
+                acc[1] += ext_size
+            for key, bucket_count in contribution["sizes"].items():
+                sizes[key] = sizes.get(key, 0) + bucket_count
+            for key, bucket_count in contribution["dates"].items():
+                dates[key] = dates.get(key, 0) + bucket_count
+
+        avg = total_size / count if count else None
+        variance = max(0, total_size_sq / count - avg * avg) if count else None
+        std_deviation = math.sqrt(variance) if count else None
+
+        stats = dict()
+        stats["total_count"] = count
+        stats["total_size"] = total_size
+        stats["size_avg"] = avg
+        stats["size_std_deviation"] = std_deviation
+        stats["size_std_deviation_bounds"] = {
+            "upper": avg + std_deviation if count else None,
+            "lower": avg - std_deviation if count else None
+        }
+        stats["size_variance"] = variance
+        stats["ext_stats"] = [(v[1], v[0], k) for k, v in sorted(ext.items(), key=lambda e: -e[1][0])[:40]]
+        stats["sizes_histogram"] = [(float(k), v) for k, v in sorted(sizes.items(), key=lambda e: int(e[0]))
+                                    if v >= 500]
+        stats["dates_histogram"] = [(k, v) for k, v in sorted(dates.items()) if v >= 500]
+        stats["website_scatter"] = sorted(websites, key=lambda w: -w[1])[:600]
+        stats["base_url"] = "entire database"
+
+        return stats
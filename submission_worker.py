@@ -0,0 +1,17 @@
+import time
+
+import redis
+
+import config
+from submissions import SubmissionQueue, SubmissionWorker
+from tasks import TaskManager
+
+tm = TaskManager()
+queue = SubmissionQueue(redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT))
+
+worker = SubmissionWorker(queue, tm.db, tm, threads=config.SUBMIT_WORKER_THREADS,
+                          host_interval=config.SUBMIT_HOST_INTERVAL)
+worker.start()
+
+while True:
+    time.sleep(60)
@@ -0,0 +1,296 @@
+import json
+import logging
+import os
+import socket
+import time
+from threading import Thread, Lock
+from urllib.parse import urlparse
+from uuid import uuid4
+
+import config
+import od_util
+from database import Website
+from tasks import Task
+
+logger = logging.getLogger("default")
+
+QUEUE_KEY = "oddb:submit:queue"
+PROCESSING_KEY = "oddb:submit:processing:"
+DELAYED_KEY = "oddb:submit:delayed"
+JOB_KEY = "oddb:submit:job:"
+RESULT_KEY = "oddb:submit:result:"
+LOCK_KEY = "oddb:submit:lock:"
+
+PENDING = "pending"
+
+
+def try_submit(db, task_manager, url, logged_ip, logged_useragent, priority=1):
+    """
+    Validate and insert a submitted website, returns (message, message type, website id, permanent).
+    permanent is True for rejections that a new submission of the url would get again.
+    """
+
+    url = os.path.join(url, "")
+    url = od_util.get_top_directory(url)
+
+    if not od_util.is_valid_url(url):
+        return "<strong>Error:</strong> Invalid url. Make sure to include the appropriate scheme.", \
+               "warning", None, True
+
+    website = db.get_website_by_url(url)
+    if website:
+        return "Website already exists", "danger", None, False
+
+    website = db.website_exists(url)
+    if website:
+        return "A parent directory of this url has already been posted", "danger", None, False
+
+    if db.is_blacklisted(url):
+        return "<strong>Error:</strong> " \
+               "Sorry, this website has been blacklisted. If you think " \
+               "this is an error, please <a href='/contribute'>contact me</a>.", "danger", None, False
+
+    if not od_util.is_od(url):
+        # The fetcher cached the page of the od check, servers that did not answer may be back up later
+        page = od_util.fetcher.get(url) if url.startswith("http") and config.SUBMIT_HTTP else None
+        permanent = page is not None and page.status_code < 500
+        return "<strong>Error:</strong>" \
+               "The anti-spam algorithm determined that the submitted url is not " \
+               "an open directory or the server is not responding. If you think " \
+               "this is an error, please <a href='/contribute'>contact me</a>.", "danger", None, permanent
+
+    website_id = db.insert_website(Website(url, logged_ip, logged_useragent))
+
+    task = Task(website_id, url, priority=priority)
+    task_manager.queue_task(task)
+
+    return "The website has been added to the queue", "success", website_id, False
+
+
+class SubmissionQueue:
+    """
+    Redis queue of submitted urls. Submitters get a job id, the results of the
+    job's urls are written back by the SubmissionWorker.
+
+    Popped items are kept in a processing list of the consumer until they are acknowledged,
+    items left there by a consumer that stopped are queued again when it restarts. Items
+    delayed by the consumer wait in a sorted set until they are due.
+    """
+
+    # Due items of the delayed set are moved to the queue, a few at a time
+    MOVE_DUE_SCRIPT = """
+    local items = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, 100)
+    for _, item in ipairs(items) do
+        redis.call("ZREM", KEYS[1], item)
+        redis.call("RPUSH", KEYS[2], item)
+    end
+    return #items
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._move_due = redis.register_script(SubmissionQueue.MOVE_DUE_SCRIPT)
+
+    def submit(self, urls, logged_ip, logged_useragent, priority=1) -> str:
+        job_id = str(uuid4())
+
+        # Duplicates within a submission are only checked once
+        urls = list(dict.fromkeys(os.path.join(url.strip(), "") for url in urls if url.strip()))
+
+        pipe = self.redis.pipeline()
+        if urls:
+            pipe.hset(JOB_KEY + job_id, mapping={url: json.dumps({"status": PENDING}) for url in urls})
+            pipe.expire(JOB_KEY + job_id, config.SUBMIT_JOB_TTL)
+            pipe.lpush(QUEUE_KEY, *(json.dumps({
+                "job": job_id,
+                "url": url,
+                "ip": logged_ip,
+                "useragent": logged_useragent,
+                "priority": priority,
+            }) for url in urls))
+        pipe.execute()
+
+        logger.info("Submission job %s: %d urls" % (job_id, len(urls)))
+        return job_id
+
+    def get_job(self, job_id: str):
+        """Results of the urls of a job, None if it does not exist (or expired)"""
+
+        results = self.redis.hgetall(JOB_KEY + job_id)
+        if not results:
+            return None
+
+        urls = {url.decode(): json.loads(result) for url, result in results.items()}
+        counts = dict()
+        for result in urls.values():
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+
+        return {
+            "job": job_id,
+            "counts": counts,
+            "done": PENDING not in counts,
+            "urls": urls,
+        }
+
+    def pop(self, consumer: str, timeout=1):
+        """Returns (raw item, item) or None, the item must then be acknowledged or delayed"""
+        self._move_due(keys=[DELAYED_KEY, QUEUE_KEY], args=[time.time()])
+
+        raw = self.redis.brpoplpush(QUEUE_KEY, PROCESSING_KEY + consumer, timeout=timeout)
+        return (raw, json.loads(raw)) if raw else None
+
+    def ack(self, consumer: str, raw):
+        self.redis.lrem(PROCESSING_KEY + consumer, 1, raw)
+
+    def delay(self, consumer: str, raw, item: dict, until: float):
+        """Take the item out of processing, it is queued again at the until timestamp"""
+        pipe = self.redis.pipeline()
+        pipe.zadd(DELAYED_KEY, {json.dumps(item): until})
+        pipe.lrem(PROCESSING_KEY + consumer, 1, raw)
+        pipe.execute()
+
+    def recover(self, consumer: str) -> int:
+        """Queue again the items that were being processed when the consumer stopped"""
+        count = 0
+        while self.redis.rpoplpush(PROCESSING_KEY + consumer, QUEUE_KEY):
+            count += 1
+        if count:
+            logger.info("Submission queue: recovered %d items of %s" % (count, consumer))
+        return count
+
+    def set_result(self, job_id: str, url: str, result: dict):
+        self.redis.hset(JOB_KEY + job_id, url, json.dumps(result))
+
+    def get_cached_result(self, url: str):
+        result = self.redis.get(RESULT_KEY + url)
+        return json.loads(result) if result else None
+
+    def cache_result(self, url: str, result: dict):
+        self.redis.set(RESULT_KEY + url, json.dumps(result), ex=config.SUBMIT_RESULT_TTL)
+
+    def lock(self, url: str, timeout: int) -> bool:
+        return bool(self.redis.set(LOCK_KEY + url, 1, nx=True, ex=timeout))
+
+    def unlock(self, url: str):
+        self.redis.delete(LOCK_KEY + url)
+
+    def get_length(self) -> int:
+        pipe = self.redis.pipeline()
+        pipe.llen(QUEUE_KEY)
+        pipe.zcard(DELAYED_KEY)
+        return sum(pipe.execute())
+
+
+class HostRateLimiter:
+    """Spaces out the requests made to the same host by at least interval seconds"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = Lock()
+        self._next = dict()
+
+    def reserve(self, url: str) -> float:
+        """Reserve the next request slot of the url's host, returns the number of seconds until it"""
+        host = urlparse(url).netloc.lower()
+
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next.get(host, 0))
+            self._next[host] = slot + self.interval
+
+            # Forget the hosts whose slot has passed
+            if len(self._next) > 10000:
+                self._next = {h: t for h, t in self._next.items() if t > now}
+
+        return slot - now
+
+
+class SubmissionWorker:
+    """
+    Processes the submission queue with a fixed number of threads: deduplication,
+    blacklist check, open directory validation and insertion
+    """
+
+    LOCK_TIMEOUT = 300
+    # Delay of the items whose url is being processed by another job
+    LOCK_RETRY_DELAY = 5
+
+    def __init__(self, queue: SubmissionQueue, db, task_manager, threads=8, host_interval=2, consumer=None):
+        self.queue = queue
+        self.db = db
+        self.task_manager = task_manager
+        self.threads = threads
+        self.rate_limiter = HostRateLimiter(host_interval)
+        self.consumer = consumer or socket.gethostname()
+
+    def start(self):
+        self.queue.recover(self.consumer)
+
+        logger.info("Starting %d submission worker threads" % self.threads)
+        for _ in range(self.threads):
+            t = Thread(target=self._run)
+            t.setDaemon(True)
+            t.start()
+
+    def _run(self):
+        while True:
+            try:
+                popped = self.queue.pop(self.consumer)
+            except Exception as e:
+                logger.error("Could not read submission queue: %s" % e)
+                time.sleep(5)
+                continue
+
+            if not popped:
+                continue
+
+            raw, item = popped
+            try:
+                self._handle(raw, item)
+            except Exception as e:
+                # The item stays in the processing list and is recovered on restart
+                logger.error("Could not save submission result of %s: %s" % (item["url"], e))
+
+    def _handle(self, raw, item: dict):
+        url = item["url"]
+
+        result = self.queue.get_cached_result(url)
+        if not result:
+            if "slot" not in item:
+                # Wait for the host's slot in the delayed set rather than in this thread
+                item["slot"] = time.time() + self.rate_limiter.reserve(url)
+                if item["slot"] > time.time():
+                    self.queue.delay(self.consumer, raw, item, item["slot"])
+                    return
+
+            # The same url submitted in another job is processed only once
+            if not self.queue.lock(url, self.LOCK_TIMEOUT):
+                self.queue.delay(self.consumer, raw, item, time.time() + self.LOCK_RETRY_DELAY)
+                return
+            try:
+                result = self.queue.get_cached_result(url) or self.process(item)
+            finally:
+                self.queue.unlock(url)
+
+        self.queue.set_result(item["job"], url, result)
+        self.queue.ack(self.consumer, raw)
+
+    def process(self, item: dict) -> dict:
+        url = item["url"]
+
+        try:
+            message, msg_type, website_id, permanent = try_submit(self.db, self.task_manager, url, item["ip"],
+                                                                  item["useragent"], item["priority"])
+        except Exception as e:
+            logger.error("Error while processing submission %s: %s" % (url, e))
+            return {"status": "error", "message": "<strong>Error:</strong> Could not process the url"}
+
+        result = {
+            "status": "added" if msg_type == "success" else "rejected",
+            "message": message,
+            "website_id": website_id,
+        }
+        if permanent:
+            self.queue.cache_result(url, result)
+        logger.debug("Submission %s: %s" % (url, result["status"]))
+        return result
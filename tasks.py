@@ -1,20 +1,27 @@
 import json
 import logging
-import os
+import random
 import time
 import traceback
 from multiprocessing.pool import ThreadPool
-from tempfile import NamedTemporaryFile
-from threading import Thread
+from tempfile import TemporaryFile
+from threading import Thread, Condition, Lock
 from uuid import uuid4
 
-import requests
+import redis
 import urllib3
+from apscheduler.schedulers.background import BackgroundScheduler
 
 import config
 import database
-from database import Website
+from download import stream_lines
+from recrawl import RecrawlScheduler
+from search.bulk import BulkThrottle
+from search.cache import SearchCache
+from search.generations import GenerationStore
+from search.links import website_root
 from search.search import ElasticSearchEngine
+from stats import StatsGenerator, WebsiteContribution
 from task_tracker_drone.src.tt_drone.api import TaskTrackerApi, Worker
 from ws_bucket_client.api import WsBucketApi
 
@@ -63,12 +70,18 @@ class IndexingTask:
 class TaskManager:
 
     def __init__(self):
-        self.search = ElasticSearchEngine(config.ES_URL, config.ES_INDEX)
+        self.redis = redis.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT)
+        self.generations = GenerationStore(self.redis)
+        self.search_cache = SearchCache(self.redis, config.SEARCH_CACHE_TTL)
+        self.search = ElasticSearchEngine(config.ES_URL, config.ES_INDEX, generations=self.generations)
         self.db = database.Database(config.DB_CONN_STR)
+        self.stats = StatsGenerator(self.db, self.search, self.redis)
+        self.throttle = BulkThrottle(config.INDEXER_MAX_IN_FLIGHT_BYTES)
+        self.recrawl = RecrawlScheduler(self.db)
         self.tracker = TaskTrackerApi(config.TT_API)
 
         self.bucket = WsBucketApi(config.WSB_API, config.WSB_SECRET)
-        self._indexer_threads = list()
+        self.indexer = None
 
         self.worker = Worker.from_file(self.tracker)
         if not self.worker:
@@ -81,111 +94,384 @@ class TaskManager:
             self.worker.request_access(config.TT_INDEX_PROJECT, True, False)
 
     def start_indexer_threads(self):
-        logger.info("Starting %s indexer threads " % (config.INDEXER_THREADS, ))
-        for _ in range(config.INDEXER_THREADS):
-            t = Thread(target=self._do_indexing)
-            t.setDaemon(True)
-            self._indexer_threads.append(t)
-            t.start()
-
-    def _do_indexing(self):
-
-        while True:
-            task = self.worker.fetch_task(project_id=config.TT_INDEX_PROJECT)
-
-            if task:
+        self.indexer = IndexerSupervisor(self, self.throttle,
+                                         min_threads=config.INDEXER_MIN_THREADS,
+                                         max_threads=config.INDEXER_MAX_THREADS,
+                                         target_latency=config.INDEXER_TARGET_LATENCY,
+                                         idle_max=config.INDEXER_IDLE_MAX)
+        self.indexer.start(config.INDEXER_THREADS, config.INDEXER_SCALE_INTERVAL)
+
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(self._collect_generations, "interval", seconds=30)
+        scheduler.start()
+
+    def index_task(self, task):
+        try:
+            recipe = task.json_recipe()
+            logger.debug("Got indexing task: " + str(recipe))
+
+            # Documents are indexed while the crawl result is being downloaded (except in full indexing mode)
+            lines = stream_lines(config.WSB_API + "/slot?token=" + recipe["upload_token"],
+                                 chunk_size=config.DOWNLOAD_CHUNK_SIZE,
+                                 max_memory=config.DOWNLOAD_MAX_MEMORY,
+                                 max_retries=config.DOWNLOAD_MAX_RETRIES)
+
+            self._complete_task(lines, Task(recipe["website_id"], recipe["url"]))
+        except Exception as e:
+            logger.error("Error while indexing task %s: %s" % (task.id, e))
+            self.worker.release_task(task_id=task.id, result=1, verification=0)
+        finally:
+            try:
+                self.worker.release_task(task_id=task.id, result=0, verification=0)
+            except:
+                pass
+
+    def _complete_task(self, lines, task):
+        """lines: NDJSON crawl result of the website"""
+
+        start = time.time()
+        contribution = WebsiteContribution()
+        website_url = website_root(task.url) if config.INDEX_WEBSITE_URL else None
+
+        if config.INDEXING_MODE == "incremental":
+            result = self.search.import_json_incremental(lines, task.website_id,
+                                                         max_bytes=config.INDEXER_BULK_MAX_BYTES,
+                                                         max_in_flight=config.INDEXER_BULK_IN_FLIGHT,
+                                                         stats=contribution, throttle=self.throttle,
+                                                         website_url=website_url)
+            if website_url:
+                # Unchanged documents indexed before website_url was stored. The documents without file_id
+                # are left to the deletion started by the import
                 try:
-                    recipe = task.json_recipe()
-                    logger.debug("Got indexing task: " + str(recipe))
-
-                    filename = download_file(config.WSB_API + "/slot?token=" + recipe["upload_token"])
-
-                    self._complete_task(filename, Task(recipe["website_id"], recipe["url"]))
+                    self.search.start_backfill_website_url(task.website_id, website_url, tracked_only=True)
                 except Exception as e:
-                    self.worker.release_task(task_id=task.id, result=1, verification=0)
-                finally:
-                    try:
-                        self.worker.release_task(task_id=task.id, result=0, verification=0)
-                    except:
-                        pass
-            else:
-                time.sleep(5)
-
-    def _complete_task(self, file_list, task):
-
-        self.search.delete_docs(task.website_id)
-
-        if file_list:
-            def iter_lines():
-                with open(file_list, "r") as f:
-                    line = f.readline()
-                    while line:
-                        yield line
-                        line = f.readline()
-
-            self.search.import_json(iter_lines(), task.website_id)
-            os.remove(file_list)
+                    logger.error("Could not start website url backfill of %d: %s" % (task.website_id, e))
+        elif config.INDEXING_MODE == "generation":
+            generation = self.generations.new_generation(task.website_id)
+            try:
+                result = self.search.import_json(lines, task.website_id,
+                                                 max_bytes=config.INDEXER_BULK_MAX_BYTES,
+                                                 max_in_flight=config.INDEXER_BULK_IN_FLIGHT,
+                                                 generation=generation, stats=contribution, throttle=self.throttle,
+                                                 website_url=website_url)
+                # The whole generation must be searchable before it replaces the previous one
+                self.search.refresh()
+            except:
+                self.generations.discard(task.website_id, generation)
+                raise
+            self.generations.publish(task.website_id, generation)
+            result["generation"] = generation
+        else:
+            # The documents are only deleted once the whole crawl was received, a failed download
+            # leaves the website as it was
+            with TemporaryFile("w+") as f:
+                for line in lines:
+                    f.write(line + "\n")
+                f.seek(0)
+
+                self.search.delete_docs(task.website_id)
+                result = self.search.import_json(f, task.website_id,
+                                                 max_bytes=config.INDEXER_BULK_MAX_BYTES,
+                                                 max_in_flight=config.INDEXER_BULK_IN_FLIGHT,
+                                                 stats=contribution, throttle=self.throttle,
+                                                 website_url=website_url)
+        logger.info("Indexed website %d (%s): %s" % (task.website_id, config.INDEXING_MODE, result))
+        self.search_cache.invalidate_website(task.website_id)
+
+        try:
+            self.stats.update_website(task.website_id, contribution)
+        except Exception as e:
+            logger.error("Could not update stats of website %d: %s" % (task.website_id, e))
+
+        if "unchanged" in result and result["changed"] + result["unchanged"]:
+            changed = (result["added"] + result["changed"] + result["removed"]) / \
+                      (result["added"] + result["changed"] + result["unchanged"] + result["removed"])
+        else:
+            # First crawl of the website, first incremental crawl after its documents were indexed with
+            # other ids (nothing matches) or not indexed incrementally
+            changed = None
+        try:
+            self.db.insert_crawl_history(task.website_id, contribution.count, contribution.size, changed,
+                                         time.time() - start)
+        except Exception as e:
+            logger.error("Could not record crawl of website %d: %s" % (task.website_id, e))
 
         self.db.update_website_date_if_exists(task.website_id)
 
+    def _collect_generations(self):
+        """Delete the documents of retired generations, off the indexing path"""
+
+        for website_id, generation, state in self.generations.get_gc_entries():
+            if state.get("pending", 0) > time.time() - GenerationStore.PENDING_TIMEOUT:
+                # Still being indexed
+                continue
+            try:
+                if state.get("task"):
+                    progress = self.search.get_task_progress(state["task"])
+                    if not progress["completed"]:
+                        continue
+                    if not progress["error"]:
+                        logger.debug("Collected generation %s of %d (%d docs)"
+                                     % (generation, website_id, progress["deleted"]))
+                        self.generations.collected(website_id, generation)
+                        continue
+                    logger.error("Could not collect generation %s of %d: %s"
+                                 % (generation, website_id, progress["error"]))
+
+                state["task"] = self.search.start_delete_generation(website_id, generation)
+                self.generations.set_gc_state(website_id, generation, state)
+            except Exception as e:
+                logger.error("Error while collecting generation %s of %d: %s" % (generation, website_id, e))
+
     def do_recrawl(self):
         logger.debug("Creating re-crawl tasks")
         self._generate_crawling_tasks()
 
     def _generate_crawling_tasks(self):
 
-        # TODO: Insert more in-depth re-crawl logic here
-        websites_to_crawl = self.db.get_oldest_updated_websites(config.RECRAWL_POOL_SIZE, prefix="http")
-
-        def recrawl(website: Website):
-            crawl_task = Task(website.id, website.url,
-                              priority=(int((time.time() - website.last_modified.timestamp()) / 3600)))
-            self.queue_task(crawl_task)
-
-        pool = ThreadPool(processes=30)
-        pool.map(func=recrawl, iterable=websites_to_crawl)
+        now = time.time()
+        tasks = [Task(e.website.id, e.website.url, priority=int(e.due(now) * 100))
+                 for e in self.recrawl.get_queue(prefix="http")]
+        self.queue_tasks(tasks)
+
+    def queue_tasks(self, tasks: list, concurrency=None, batch_size=None, rate=None) -> list:
+        """
+        Queue tasks in batches of batch_size, with at most concurrency tasks (and tracker/bucket requests)
+        at a time and at most rate tasks per second. The next batch starts while the requests of the
+        previous one complete, the result of each batch is logged when all its tasks are done.
+        Returns the website ids of the tasks that could not be queued.
+        """
+        concurrency = concurrency or config.QUEUE_CONCURRENCY
+        batch_size = batch_size or config.QUEUE_BATCH_SIZE
+        limiter = RateLimiter(config.QUEUE_RATE if rate is None else rate)
+        start = time.time()
+
+        def queue(task):
+            limiter.wait()
+            try:
+                return self.queue_task(task)
+            except Exception as e:
+                logger.error("Could not queue task of website %d: %s" % (task.website_id, e))
+                return False
+
+        batches = [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+        failed = []
+        pool = ThreadPool(processes=max(1, min(concurrency, len(tasks))))
+        results = pool.imap(queue, tasks)
+        for i, batch in enumerate(batches):
+            batch_failed = [task.website_id for task in batch if not next(results)]
+            failed.extend(batch_failed)
+            logger.info("Queue batch %d/%d: %d queued, %d failed (%.2fs)"
+                        % (i + 1, len(batches), len(batch) - len(batch_failed), len(batch_failed),
+                           time.time() - start))
+            if batch_failed:
+                logger.error("Could not queue tasks of websites %s" % batch_failed)
         pool.close()
 
-    def queue_task(self, task: Task):
+        logger.info("Queued %d/%d tasks (%.2fs)" % (len(tasks) - len(failed), len(tasks), time.time() - start))
+        return failed
+
+    def queue_task(self, task: Task) -> bool:
         max_assign_time = 24 * 4 * 3600
         upload_token = uuid4().__str__()
 
         task.upload_token = upload_token
-        tracker_response = self.worker.submit_task(config.TT_CRAWL_PROJECT,
-                                                   recipe=task.__str__(),
-                                                   priority=task.priority,
-                                                   max_assign_time=max_assign_time,
-                                                   hash64=task.website_id,
-                                                   verification_count=1,
-                                                   max_retries=3
-                                                   )
-        print(tracker_response.text)
-        logging.info("Queued task and made it available to crawlers: t=%s, r=%s" % (task, tracker_response.text))
-        if not tracker_response.json()["ok"]:
+        tracker_response = _retry(lambda: self.worker.submit_task(config.TT_CRAWL_PROJECT,
+                                                                  recipe=task.__str__(),
+                                                                  priority=task.priority,
+                                                                  max_assign_time=max_assign_time,
+                                                                  hash64=task.website_id,
+                                                                  verification_count=1,
+                                                                  max_retries=3
+                                                                  ))
+        logger.debug("Queued task and made it available to crawlers: t=%s, r=%s"
+                     % (task, tracker_response.text if tracker_response is not None else None))
+        try:
+            if tracker_response is None or not tracker_response.json()["ok"]:
+                return False
+        except ValueError:
+            logger.error("Invalid tracker response for website %d: HTTP %d %s"
+                         % (task.website_id, tracker_response.status_code, tracker_response.text[:200]))
+            return False
+
+        bucket_response = _retry(lambda: self.bucket.allocate(upload_token.__str__(),
+                                                              21474837499,  # 20Gib
+                                                              format_file_name(task.website_id, upload_token),
+                                                              to_dispose_date=int(time.time() + max_assign_time),
+                                                              upload_hook=""))
+        logger.debug("Allocated upload bucket: %d, t=%s, r=%s"
+                     % (task.website_id, upload_token, bucket_response.text if bucket_response is not None else None))
+        return bucket_response is not None and bucket_response.status_code < 300
+
+
+class RateLimiter:
+    """Spaces out calls to wait() by at least 1/rate seconds, rate <= 0 disables the limit"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._lock = Lock()
+        self._next = 0
+
+    def wait(self):
+        if not self.interval:
             return
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _retry(request, max_retries=None, base_delay=0.5):
+    """
+    Retry a tracker/bucket HTTP request on connection errors and 5xx/429 responses,
+    with exponential backoff and full jitter. Returns None when all attempts failed.
+    """
+    max_retries = config.QUEUE_MAX_RETRIES if max_retries is None else max_retries
+
+    for attempt in range(max_retries + 1):
+        try:
+            response = request()
+            if response.status_code < 500 and response.status_code != 429:
+                return response
+            error = "HTTP %d" % response.status_code
+        except Exception as e:
+            error = str(e)
+
+        if attempt < max_retries:
+            delay = random.uniform(0, base_delay * 2 ** attempt)
+            logger.debug("Request failed (%s), retrying in %.2fs" % (error, delay))
+            time.sleep(delay)
+        else:
+            logger.error("Request failed after %d attempts: %s" % (attempt + 1, error))
+    return None
+
+
+class IndexerSupervisor:
+    """
+    Runs the indexer threads and adjusts their number: a thread is added while all of them
+    are busy, the count is halved when ES rejects or slows down bulk requests and idle
+    threads are retired, leaving one to poll the tracker.
+    """
+
+    METRICS_KEY = "oddb:indexer:metrics"
+    IDLE_DELAY = 5
+
+    def __init__(self, task_manager: TaskManager, throttle: BulkThrottle, min_threads=1, max_threads=8,
+                 target_latency=5, idle_max=60):
+        self.tm = task_manager
+        self.throttle = throttle
+        self.min_threads = max(1, min_threads)
+        self.max_threads = max(self.min_threads, max_threads)
+        self.target_latency = target_latency
+        self.idle_max = idle_max
+        self._interval = 0
+
+        self._cond = Condition()
+        self._target = self.min_threads
+        self._active = 0
+        self._busy = 0
+        self._fetched = 0
+        self._empty_polls = 0
+        self._window = {}
+
+    def start(self, threads: int, interval: int):
+        self._interval = interval
+        with self._cond:
+            self._target = min(self.max_threads, max(self.min_threads, threads))
+            logger.info("Starting %d indexer threads" % self._target)
+            self._spawn()
+
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(self.adjust, "interval", seconds=interval)
+        scheduler.start()
+
+    def _spawn(self):
+        while self._active < self._target:
+            self._active += 1
+            t = Thread(target=self._run)
+            t.setDaemon(True)
+            t.start()
 
-        bucket_response = self.bucket.allocate(upload_token.__str__(),
-                                               21474837499,  # 20Gib
-                                               format_file_name(task.website_id, upload_token),
-                                               to_dispose_date=int(time.time() + max_assign_time),
-                                               upload_hook="")
-        logging.info("Allocated upload bucket: %d, t=%s, r=%s" % (task.website_id, upload_token, bucket_response.text))
+    def _run(self):
+        delay = self.IDLE_DELAY
+
+        while True:
+            with self._cond:
+                if self._active > self._target:
+                    self._active -= 1
+                    return
+
+            try:
+                task = self.tm.worker.fetch_task(project_id=config.TT_INDEX_PROJECT)
+            except Exception as e:
+                logger.error("Could not fetch indexing task: %s" % e)
+                task = None
+
+            if not task:
+                with self._cond:
+                    self._empty_polls += 1
+                    # Woken up early when the thread is retired
+                    self._cond.wait(delay)
+                delay = min(delay * 2, self.idle_max)
+                continue
+
+            delay = self.IDLE_DELAY
+            with self._cond:
+                self._fetched += 1
+                self._busy += 1
+            try:
+                self.tm.index_task(task)
+            except Exception as e:
+                logger.error("Indexer thread error: %s" % e)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+
+    def adjust(self):
+        window = self.throttle.get_window()
+
+        with self._cond:
+            window["fetched"] = self._fetched
+            window["empty_polls"] = self._empty_polls
+            self._fetched = 0
+            self._empty_polls = 0
+
+            target = self._target
+            if window["rejections"] or window["latency"] > self.target_latency:
+                target = max(self.min_threads, target // 2)
+            elif not window["empty_polls"] and self._busy >= self._active:
+                target = min(self.max_threads, target + 1)
+            elif window["empty_polls"] and self._busy < self._active:
+                target = min(target, max(self.min_threads, self._busy + 1))
+
+            if target != self._target:
+                logger.info("Indexer threads: %d -> %d (%s)" % (self._target, target, window))
+                self._target = target
+                self._spawn()
+                self._cond.notify_all()
+            self._window = window
+
+        try:
+            self.tm.redis.set(self.METRICS_KEY, json.dumps(self.get_metrics()), ex=self._interval * 4)
+        except Exception as e:
+            logger.error("Could not publish indexer metrics: %s" % e)
+
+    def get_metrics(self) -> dict:
+        with self._cond:
+            return {
+                "target_threads": self._target,
+                "threads": self._active,
+                "busy_threads": self._busy,
+                # The tracker client cannot tell the length of the queue, a backlog is assumed
+                # when no thread found it empty during the last interval
+                "backlog": bool(self._window.get("fetched")) and not self._window.get("empty_polls"),
+                "in_flight_bytes": self.throttle.get_in_flight(),
+                "max_in_flight_bytes": self.throttle.max_bytes,
+                "last_interval": self._window,
+            }
 
 
 def format_file_name(website_id, token):
     return "%d_%s.NDJSON" % (website_id, token,)
-
-
-def download_file(url):
-    r = requests.get(url, stream=True,)
-
-    if r.status_code != 200:
-        raise ValueError("HTTP error %d: %s" % (r.status_code, url))
-
-    tmp = NamedTemporaryFile(delete=False)
-    for chunk in r.iter_content(chunk_size=4096):
-        if chunk:
-            tmp.write(chunk)
-    tmp.close()
-
-    return tmp.name
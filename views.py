@@ -1,18 +1,19 @@
 import json
 import os
-from multiprocessing.pool import Pool
 from urllib.parse import urlparse
 
-from flask import render_template, redirect, request, flash, abort, Response, session
+from flask import render_template, redirect, request, flash, abort, Response, session, send_file
 from flask_caching import Cache
 
 import captcha
 import config
 import od_util
-from common import db, taskManager, searchEngine, logger, require_role
-from database import Website
+from common import db, taskManager, searchEngine, searchCache, statsGenerator, linkListCache, logger, require_role, \
+    redis, submissionQueue
 from search.search import InvalidQueryException
-from tasks import Task
+from stats import get_website_stats
+from submissions import try_submit
+from tasks import Task, IndexerSupervisor
 
 
 def setup_views(app):
@@ -30,11 +31,11 @@ def setup_views(app):
         dir_content = os.listdir(dl_dir)
 
         # Make paths relative to working directory
-        # Only allow csv files
+        # Only allow csv and parquet files
         files = [
             (name, os.path.join(dl_dir, name))
             for name in dir_content
-            if name.find(".csv") != -1
+            if name.find(".csv") != -1 or name.endswith(".parquet")
         ]
 
         # Stat files
@@ -58,28 +59,64 @@ def setup_views(app):
     @app.route("/stats/json_chart")
     @cache.cached(240)
     def stats_json():
-        stats = searchEngine.get_global_stats()
+        stats = statsGenerator.get_global_stats()
         if stats:
             db.join_website_on_stats(stats)
             return Response(json.dumps(stats), mimetype="application/json")
         return abort(500)
 
+    def get_delete_progress(website_id):
+        key = "oddb:delete_progress:%d" % website_id
+        state = redis.get(key)
+        if not state:
+            return None
+
+        state = json.loads(state)
+        if state.get("progress"):
+            # Completed, ES is not asked again
+            return state["progress"]
+        try:
+            progress = searchEngine.get_task_progress(state["task"])
+        except Exception as e:
+            logger.error("Could not get progress of delete task %s: %s" % (state["task"], e))
+            return None
+
+        if progress["completed"]:
+            ttl = redis.ttl(key)
+            if ttl > 0:
+                redis.set(key, json.dumps({"task": state["task"], "progress": progress}), ex=ttl, xx=True)
+        return progress
+
+    def start_delete_docs(website_id):
+        task_id = searchEngine.start_delete_docs(website_id)
+        searchCache.invalidate_website(website_id)
+        redis.set("oddb:delete_progress:%d" % website_id, json.dumps({"task": task_id}), ex=24 * 3600)
+
     @app.route("/website/<int:website_id>/")
     def website_info(website_id):
         website = db.get_website_by_id(website_id)
 
         if website:
-            return render_template("website.html", website=website)
+            return render_template("website.html", website=website, delete_progress=get_delete_progress(website_id))
         else:
             abort(404)
 
+    @app.route("/website/<int:website_id>/delete_progress")
+    def website_delete_progress(website_id):
+        require_role("admin")
+
+        progress = get_delete_progress(website_id)
+        if progress:
+            return Response(json.dumps(progress), mimetype="application/json")
+        abort(404)
+
     @app.route("/website/<int:website_id>/json_chart")
     @cache.memoize(60)
     def website_json_chart(website_id):
         website = db.get_website_by_id(website_id)
 
         if website:
-            stats = searchEngine.get_stats(website_id)
+            stats = get_website_stats(db, searchEngine, website_id)
             stats["base_url"] = website.url
             stats["report_time"] = website.last_modified
             return Response(json.dumps(stats), mimetype="application/json")
@@ -91,8 +128,22 @@ def setup_views(app):
         website = db.get_website_by_id(website_id)
 
         if website:
-            links = searchEngine.get_link_list(website_id, website.url)
-            return Response("\n".join(links), mimetype="text/plain")
+            path = linkListCache.get_path(website)
+            cached = os.path.exists(path)
+            encoding = request.accept_encodings.best_match(linkListCache.get_encodings(cached))
+
+            if cached and encoding == "gzip":
+                # Content-Length, ETag and Range requests are handled by send_file()
+                response = send_file(path, mimetype="text/plain", conditional=True)
+            elif cached:
+                response = Response(linkListCache.read(path), mimetype="text/plain")
+            else:
+                response = Response(linkListCache.stream(website, encoding), mimetype="text/plain")
+
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+            response.headers["Vary"] = "Accept-Encoding"
+            return response
         else:
             abort(404)
 
@@ -126,17 +177,21 @@ def setup_views(app):
     def admin_clear_website(website_id):
         require_role("admin")
 
-        searchEngine.delete_docs(website_id)
-        flash("Cleared all documents associated with this website", "success")
+        start_delete_docs(website_id)
+        db.delete_website_stats(website_id)
+        linkListCache.delete(website_id)
+        flash("Started clearing all documents associated with this website", "success")
         return redirect("/website/" + str(website_id))
 
     @app.route("/website/<int:website_id>/delete")
     def admin_delete_website(website_id):
         require_role("admin")
 
-        searchEngine.delete_docs(website_id)
+        start_delete_docs(website_id)
         db.delete_website(website_id)
-        flash("Deleted website " + str(website_id), "success")
+        linkListCache.delete(website_id)
+        flash("Deleted website " + str(website_id) + ", its documents are being removed "
+              "(<a href='/website/" + str(website_id) + "/delete_progress'>progress</a>)", "success")
         return redirect("/website/")
 
     @app.route("/website/<int:website_id>/rescan")
@@ -205,9 +260,15 @@ def setup_views(app):
             if not config.CAPTCHA_SEARCH or captcha.verify():
 
                 try:
-                    hits = searchEngine.search(q, page, per_page, sort_order,
-                                               extensions, size_min, size_max, match_all, fields, date_min, date_max)
-                    hits = db.join_website_on_search_result(hits)
+                    searchEngine.check_query(q)
+                    cache_key = searchCache.make_key(q, page, per_page, sort_order, extensions, size_min, size_max,
+                                                     match_all, fields, date_min, date_max)
+                    hits = searchCache.get(cache_key)
+                    if hits is None:
+                        hits = searchEngine.search(q, page, per_page, sort_order, extensions, size_min, size_max,
+                                                   match_all, fields, date_min, date_max)
+                        hits = db.join_website_on_search_result(hits)
+                        searchCache.set(cache_key, hits)
                 except InvalidQueryException as e:
                     flash("<strong>Invalid query:</strong> " + str(e), "warning")
                     blocked = True
@@ -255,7 +316,7 @@ def setup_views(app):
     @app.route("/")
     def home():
         try:
-            stats = searchEngine.get_global_stats()
+            stats = statsGenerator.get_global_stats()
             stats["website_count"] = len(db.get_all_websites())
         except:
             stats = {}
@@ -267,39 +328,10 @@ def setup_views(app):
         return render_template("submit.html", captcha=captcha, show_captcha=config.CAPTCHA_SUBMIT)
 
     def try_enqueue(url):
-        url = os.path.join(url, "")
-        url = od_util.get_top_directory(url)
-
-        if not od_util.is_valid_url(url):
-            return "<strong>Error:</strong> Invalid url. Make sure to include the appropriate scheme.", "warning"
-
-        website = db.get_website_by_url(url)
-        if website:
-            return "Website already exists", "danger"
-
-        website = db.website_exists(url)
-        if website:
-            return "A parent directory of this url has already been posted", "danger"
-
-        if db.is_blacklisted(url):
-            return "<strong>Error:</strong> " \
-                   "Sorry, this website has been blacklisted. If you think " \
-                   "this is an error, please <a href='/contribute'>contact me</a>.", "danger"
-
-        if not od_util.is_od(url):
-            return "<strong>Error:</strong>" \
-                   "The anti-spam algorithm determined that the submitted url is not " \
-                   "an open directory or the server is not responding. If you think " \
-                   "this is an error, please <a href='/contribute'>contact me</a>.", "danger"
-
-        website_id = db.insert_website(Website(url, str(request.remote_addr + "_" +
-                                                        request.headers.get("X-Forwarded-For", "")),
-                                               request.user_agent))
-
-        task = Task(website_id, url, priority=1)
-        taskManager.queue_task(task)
-
-        return "The website has been added to the queue", "success"
+        message, msg_type, _, _ = try_submit(db, taskManager, url,
+                                             str(request.remote_addr + "_" + request.headers.get("X-Forwarded-For", "")),
+                                             request.user_agent)
+        return message, msg_type
 
     @app.route("/enqueue", methods=["POST"])
     def enqueue():
@@ -315,11 +347,6 @@ def setup_views(app):
             flash("<strong>Error:</strong> Invalid captcha please try again", "danger")
             return redirect("/submit")
 
-    def check_url(url):
-        url = os.path.join(url, "")
-        try_enqueue(url)
-        return None
-
     @app.route("/enqueue_bulk", methods=["POST"])
     def enqueue_bulk():
         if not config.CAPTCHA_SUBMIT or captcha.verify():
@@ -330,11 +357,13 @@ def setup_views(app):
 
                 if 0 < len(urls) <= 1000:  # TODO: Load from config & adjust placeholder/messages?
 
-                    pool = Pool(processes=6)
-                    pool.map(func=check_url, iterable=urls)
-                    pool.close()
+                    job_id = submissionQueue.submit(urls,
+                                                    str(request.remote_addr + "_" +
+                                                        request.headers.get("X-Forwarded-For", "")),
+                                                    str(request.user_agent))
 
-                    flash("Submitted websites to the queue", "success")
+                    flash("Submitted websites to the queue, see <a href='/enqueue_bulk/%s'>the results</a>"
+                          % job_id, "success")
 
                     return redirect("/submit")
 
@@ -348,6 +377,13 @@ def setup_views(app):
             flash("<strong>Error:</strong> Invalid captcha please try again", "danger")
             return redirect("/submit")
 
+    @app.route("/enqueue_bulk/<job_id>")
+    def enqueue_bulk_status(job_id):
+        job = submissionQueue.get_job(job_id)
+        if not job:
+            abort(404)
+        return Response(json.dumps(job), mimetype="application/json")
+
     @app.route("/admin")
     def admin_login_form():
         if "username" in session:
@@ -387,6 +423,22 @@ def setup_views(app):
 
         return render_template("dashboard.html", api_tokens=tokens, blacklist=blacklist)
 
+    @app.route("/admin/metrics")
+    def admin_metrics():
+        require_role("admin")
+
+        metrics = {
+            "db_pool": db.pool.get_metrics(),
+            "search_log": db.search_log.get_metrics(),
+            "search_cache": searchCache.get_metrics(),
+            "od_check": od_util.fetcher.get_metrics(),
+            "submission_queue": submissionQueue.get_length(),
+        }
+        # Published by the indexer process
+        indexer_metrics = redis.get(IndexerSupervisor.METRICS_KEY)
+        metrics["indexer"] = json.loads(indexer_metrics) if indexer_metrics else None
+        return Response(json.dumps(metrics), mimetype="application/json")
+
     @app.route("/blacklist/add", methods=["POST"])
     def admin_blacklist_add():
         require_role("admin")